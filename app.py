@@ -1,11 +1,17 @@
 import streamlit as st
 import pandas as pd
-import requests
 import plotly.graph_objects as go
 import plotly.express as px
+from motor import (
+    CONTAS_FIXAS, SETORES_AGENTES, MAX_WORKERS_PADRAO, DIAS_JANELA_PADRAO, MAX_TENTATIVAS,
+    TTL_DESCOBERTA_S, MAX_ENTRADAS_DESCOBERTA, FORMATOS_EXPORT,
+    TAMANHOS_PAGINA, PERIODOS_TENDENCIA, DIAS_TENDENCIA_PADRAO,
+    mascara_filtros, mascara_busca, ordenar_posicoes, indicadores, tendencia, ranking_agentes,
+    autenticar, pesquisas_da_conta, servicos_da_conta, listar_pesquisas, listar_servicos_api,
+    AutenticadorApi, GerenciadorDownloads, Telemetria, gerar_exportacao, chave_exportacao, tabela_exportacao,
+    abrir_cache, ler_rollup, mesclar_relatorios,
+)
 from datetime import datetime, timedelta
-import time
-import io
 
 # ==============================================================================
 # 1. CONFIGURAÇÃO DA PÁGINA
@@ -22,12 +28,20 @@ if "app_access" not in st.session_state: st.session_state["app_access"] = False
 if "token" not in st.session_state: st.session_state["token"] = None
 if "pesquisas_list" not in st.session_state: st.session_state["pesquisas_list"] = []
 if "servicos_list" not in st.session_state: st.session_state["servicos_list"] = [] 
-# Novo estado para armazenar os dados brutos baixados e permitir filtragem posterior
-if "df_raw_cache" not in st.session_state: st.session_state["df_raw_cache"] = None
-
-# IDs CRÍTICOS (Filtros de Exclusão)
-ID_PESQUISA_V3 = "43"
-ID_PERGUNTA_IGNORAR_V3 = "40" 
+# Chave dos dados carregados no repositório do processo (DataFrame + cubo + índice de dedup ficam lá,
+# uma vez só para todas as sessões que abrirem o mesmo relatório; a sessão guarda só filtros e visões)
+if "dados_chave" not in st.session_state: st.session_state["dados_chave"] = None
+# Versão dos dados carregados + último arquivo exportado (gerado só sob demanda)
+if "dados_versao" not in st.session_state: st.session_state["dados_versao"] = None
+if "export_cache" not in st.session_state: st.session_state["export_cache"] = None
+# Posições (iloc) das linhas filtradas e da visão da tabela (busca + ordenação), por chave de filtros
+if "tabela_cache" not in st.session_state: st.session_state["tabela_cache"] = None
+if "estatisticas_download" not in st.session_state: st.session_state["estatisticas_download"] = None
+if "relatorio_upload" not in st.session_state: st.session_state["relatorio_upload"] = None
+# Medições do download/processamento dos dados carregados (+ consultas e exportações da sessão)
+if "telemetria" not in st.session_state: st.session_state["telemetria"] = None
+# IDs dos downloads em segundo plano disparados por esta sessão
+if "jobs" not in st.session_state: st.session_state["jobs"] = []
 
 # --- SEGREDOS (Credenciais) ---
 try:
@@ -41,255 +55,111 @@ except:
     API_USER_SECRET = ""
     API_PASS_SECRET = ""
 
-CONTAS_FIXAS = {
-    "1":  "117628-ATEL", "15": "ATEL Telecom", "14": "ATELAtivo-V2",
-    "13": "ClienteInterno_V2", "12": "TráfegoPago_V2", "11": "SUPORTE ATIVO",
-    "9":  "Pascoa", "7":  "Tráfego pago", "5":  "CLIENTE INTERNO", "3":  "LABORATÓRIO", "15": "ATEL Telecom - Disparos", "16": "ATEL- Lucas Valões"
-}
-
-SETORES_AGENTES = {
-    'CANCELAMENTO': ['BARBOSA', 'ELOISA', 'LARISSA', 'EDUARDO', 'CAMILA', 'SAMARA'],
-    'NEGOCIACAO': ['CARLA', 'LENK', 'ANA LUIZA', 'JULIETTI', 'RODRIGO', 'MONALISA', 'RAMOM', 'EDNAEL', 'LETICIA', 'RITA', 'MARIANA', 'FLAVIA S', 'URI', 'CLARA', 'WANDERSON', 'APARECIDA', 'CRISTINA', 'CAIO', 'LUKAS'],
-    'SUPORTE': ['VALERIO', 'TARCISIO', 'GRANJA', 'ALICE', 'FERNANDO', 'SANTOS', 'RENAN', 'FERREIRA', 'HUEMILLY', 'LOPES', 'LAUDEMILSON', 'RAYANE', 'LAYS', 'JORGE', 'LIGIA', 'ALESSANDRO', 'GEIBSON', 'ROBERTO', 'OLIVEIRA', 'MAURÍCIO', 'AVOLO', 'CLEBER', 'ROMERIO', 'JUNIOR', 'ISABELA', 'WAGNER', 'CLAUDIA', 'ANTONIO', 'JOSE', 'LEONARDO', 'KLEBSON', 'OZENAIDE'],
-    'NRC': ['RILDYVAN', 'MILENA', 'ALVES', 'MONICKE', 'AYLA', 'MARIANY', 'EDUARDA', 'MENEZES', 'JUCIENNY', 'MARIA', 'ANDREZA', 'LUZILENE', 'IGO', 'AIDA', 'CARIBÉ', 'MICHELLY', 'ADRIA', 'ERICA', 'HENRIQUE', 'SHYRLEI', 'ANNA', 'JULIA', 'FERNANDES']
-}
-
-# --- AUXILIARES ---
-def normalizar_nome(nome):
-    return str(nome).strip().upper() if nome and str(nome) != "nan" else "DESCONHECIDO"
-
-def get_setor(agente):
-    nome = normalizar_nome(agente)
-    for setor, lista in SETORES_AGENTES.items():
-        if any(a in nome for a in lista): return setor
-    return 'OUTROS'
-
-def criar_link_atendimento(protocolo):
-    if not protocolo or str(protocolo) in ["0", "nan", "None", ""]: return None
-    proto_str = str(protocolo).strip().replace('.0', '')
-    cod = proto_str[-7:] if len(proto_str) >= 7 else proto_str
-    domain = API_URL_SECRET.replace("/rest/v2", "").replace("https://", "") if API_URL_SECRET else "ateltelecom.matrixdobrasil.ai"
-    if "api" in domain: domain = "ateltelecom.matrixdobrasil.ai" 
-    return f"https://{domain}/atendimento/view/cod_atendimento/{cod}/readonly/true#atendimento-div"
-
-# --- API ---
-def autenticar(url, login, senha):
-    if not url or not login: return None
-    try:
-        r = requests.post(f"{url}/rest/v2/authuser", json={"login": login, "chave": senha}, timeout=20)
-        if r.status_code == 200 and r.json().get("success"): return r.json()["result"]["token"]
-    except: pass
-    return None
-
-def listar_pesquisas(base_url, token, lista_contas, d_ini, d_fim):
-    url = f"{base_url}/rest/v2/relPesquisa"
-    headers = {"Authorization": f"Bearer {token}"}
-    encontradas = []
-    with st.spinner("Mapeando pesquisas..."):
-        for id_conta in lista_contas:
-            try:
-                params = {"data_inicial": d_ini.strftime("%Y-%m-%d"), "data_final": d_fim.strftime("%Y-%m-%d"), "id_conta": id_conta, "page": 1, "limit": 100}
-                r = requests.get(url, headers=headers, params=params, timeout=10)
-                if r.status_code == 200:
-                    for row in r.json().get("rows", []):
-                        encontradas.append({"id": str(row.get("cod_pesquisa")), "nome": row.get("nom_pesquisa")})
-            except: pass
-    return list({v['id']: v for v in encontradas}.values())
-
-def listar_servicos_api(base_url, token, id_conta, d_ini, d_fim):
-    url = f"{base_url}/rest/v2/relAtEstatistico" 
-    headers = {"Authorization": f"Bearer {token}"}
-    servicos_encontrados = set()
-    
-    with st.spinner("Carregando serviços da conta..."):
-        try:
-            params = {
-                "data_inicial": d_ini.strftime("%Y-%m-%d 00:00:00"),
-                "data_final": d_fim.strftime("%Y-%m-%d 23:59:59"),
-                "id_conta": id_conta,
-                "agrupador": "servico",
-                "limit": 500 
-            }
-            r = requests.get(url, headers=headers, params=params, timeout=25)
-            if r.status_code == 200:
-                data = r.json()
-                rows = data if isinstance(data, list) else data.get("rows", [])
-                for row in rows:
-                    nome = row.get("agrupador") 
-                    if nome and nome != "ATENDIMENTO AUTOMATICO":
-                        servicos_encontrados.add(str(nome).upper())
-        except Exception:
-            pass 
-
-        if not servicos_encontrados:
-            try:
-                dt_fallback_ini = d_fim - timedelta(days=30)
-                if dt_fallback_ini < d_ini: dt_fallback_ini = d_ini 
-                params_fallback = {
-                    "data_inicial": dt_fallback_ini.strftime("%Y-%m-%d 00:00:00"),
-                    "data_final": d_fim.strftime("%Y-%m-%d 23:59:59"),
-                    "id_conta": id_conta,
-                    "agrupador": "servico",
-                    "limit": 500
-                }
-                r = requests.get(url, headers=headers, params=params_fallback, timeout=15)
-                if r.status_code == 200:
-                    data = r.json()
-                    rows = data if isinstance(data, list) else data.get("rows", [])
-                    for row in rows:
-                        nome = row.get("agrupador") 
-                        if nome and nome != "ATENDIMENTO AUTOMATICO":
-                            servicos_encontrados.add(str(nome).upper())
-                    if servicos_encontrados:
-                        st.toast("⚠️ Serviços carregados (Base: últimos 30 dias)", icon="ℹ️")
-            except Exception:
-                pass
-
-    return sorted(list(servicos_encontrados))
-
-def baixar_dados_fracionado(base_url, token, lista_contas, lista_pesquisas, d_ini, d_fim, limit_size):
-    url = f"{base_url}/rest/v2/RelPesqAnalitico"
-    headers = {"Authorization": f"Bearer {token}"}
-    dados_unicos = {}
-    
-    intervalos = []
-    current_start = d_ini
-    while current_start <= d_fim:
-        current_end = current_start + timedelta(days=20)
-        if current_end > d_fim: current_end = d_fim
-        intervalos.append((current_start, current_end))
-        current_start = current_end + timedelta(days=1)
-        if current_start > d_fim: break
-
-    status_text = st.empty()
-    prog_bar = st.progress(0)
-    
-    total_steps = len(intervalos) * len(lista_contas) * len(lista_pesquisas)
-    current_step = 0
-    total_baixados = 0
-
-    for idx, (dt_start, dt_end) in enumerate(intervalos):
-        s_str = dt_start.strftime("%d/%m")
-        e_str = dt_end.strftime("%d/%m")
-        
-        for id_conta in lista_contas:
-            for id_pesquisa in lista_pesquisas:
-                current_step += 1
-                prog = min(current_step / max(total_steps, 1), 1.0)
-                prog_bar.progress(prog)
-                status_text.markdown(f"⏳ Baixando **{s_str} a {e_str}** | Conta {id_conta} | Pesquisa {id_pesquisa} | Encontrados: **{total_baixados}**")
-                
-                page = 1
-                retry_count = 0 
-                
-                while True:
-                    try:
-                        params = {
-                            "data_inicial": dt_start.strftime("%Y-%m-%d"),
-                            "data_final": dt_end.strftime("%Y-%m-%d"),
-                            "pesquisa": id_pesquisa,
-                            "id_conta": id_conta,
-                            "page": page,
-                            "limit": limit_size
-                        }
-                        
-                        r = requests.get(url, headers=headers, params=params, timeout=45)
-                        
-                        if r.status_code != 200:
-                            if retry_count < 2: 
-                                retry_count += 1
-                                time.sleep(1) 
-                                continue
-                            else:
-                                break 
-
-                        data = r.json()
-                        if not data: break 
-                        
-                        for bloco in data:
-                            cod_pergunta = str(bloco.get("cod_pergunta", ""))
-                            nom_pergunta = str(bloco.get("nom_pergunta", "")).lower()
-                            nome_servico = bloco.get("nom_servico") or bloco.get("servico") or "N/A"
-
-                            if str(id_pesquisa) == ID_PESQUISA_V3 and cod_pergunta == ID_PERGUNTA_IGNORAR_V3: continue
-                            if "internet" in nom_pergunta or ("serviço" in nom_pergunta and "atendimento" not in nom_pergunta): continue
-
-                            respostas = bloco.get("respostas", [])
-                            for resp in respostas:
-                                protocolo = str(resp.get("num_protocolo", ""))
-                                agente = str(resp.get("nom_agente", "DESCONHECIDO"))
-                                servico_final = nome_servico
-                                if servico_final == "N/A":
-                                    servico_final = resp.get("nom_servico") or resp.get("servico") or "N/A"
-
-                                if protocolo and protocolo != "0":
-                                    chave = f"{protocolo}_{agente}_{cod_pergunta}"
-                                else:
-                                    chave = f"noprot_{id_conta}_{id_pesquisa}_{len(dados_unicos)}"
-                                
-                                if chave not in dados_unicos:
-                                    resp['conta_origem_id'] = str(id_conta)
-                                    resp['pergunta_origem'] = bloco.get("nom_pergunta", "")
-                                    resp['nom_servico'] = str(servico_final).upper()
-                                    dados_unicos[chave] = resp
-                                    total_baixados += 1
-                        
-                        if len(data) < (limit_size / 2): break 
-                        page += 1
-                        if page > 100: break 
-
-                    except Exception as e:
-                        time.sleep(1)
-                        break 
-    
-    prog_bar.empty()
-    status_text.empty()
-    return list(dados_unicos.values())
-
-def gerar_excel(df_resumo, df_brutos):
-    """
-    Gera Excel BLINDADO. 
-    Tenta usar xlsxwriter para gráficos. Se não tiver, usa openpyxl apenas com dados.
-    """
-    output = io.BytesIO()
-    
-    cols_export = ['Data', 'Nome_Conta', 'Setor', 'Agente', 'Serviço', 'Nota', 'nom_resposta', 'Link']
-    cols_existentes = [c for c in cols_export if c in df_brutos.columns]
-    df_brutos_clean = df_brutos[cols_existentes].copy()
-    
-    if pd.api.types.is_datetime64_any_dtype(df_brutos_clean['Data']):
-            df_brutos_clean['Data'] = df_brutos_clean['Data'].dt.strftime('%d/%m/%Y %H:%M:%S')
-
-    try:
-        # Tenta modo COMPLETO (Com Gráficos) - requer xlsxwriter
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df_resumo.to_excel(writer, sheet_name='Resumo', index=False)
-            workbook = writer.book
-            worksheet = writer.sheets['Resumo']
-            
-            chart = workbook.add_chart({'type': 'column'})
-            max_row = len(df_resumo) + 1
-            chart.add_series({
-                'name':       'Satisfação (CSAT %)',
-                'categories': ['Resumo', 1, 0, max_row - 1, 0],
-                'values':     ['Resumo', 1, 1, max_row - 1, 1],
-                'gap':        20,
-            })
-            chart.set_title({'name': 'Ranking de Satisfação'})
-            chart.set_y_axis({'name': 'CSAT (%)', 'max': 100})
-            worksheet.insert_chart('E2', chart)
-            
-            df_brutos_clean.to_excel(writer, sheet_name='Dados Brutos', index=False)
-            
-    except ImportError:
-        # Modo DE SEGURANÇA (Sem Gráficos) - usa openpyxl (padrão)
-        # Reseta o buffer para não misturar dados corrompidos
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df_resumo.to_excel(writer, sheet_name='Resumo', index=False)
-            df_brutos_clean.to_excel(writer, sheet_name='Dados Brutos', index=False)
-            
-    return output.getvalue()
+# --- DOWNLOADS EM SEGUNDO PLANO ---
+INTERVALO_POLL_S = 1.0          # Atualização do painel de downloads
+
+# Descoberta (pesquisas/serviços) em cache do processo: compartilhado entre sessões, com TTL e
+# despejo LRU ao passar de MAX_ENTRADAS_DESCOBERTA. O token (_token) fica fora da chave do cache.
+# Falhas levantam exceção, e exceções não entram no cache.
+_pesquisas_da_conta = st.cache_data(ttl=TTL_DESCOBERTA_S, max_entries=MAX_ENTRADAS_DESCOBERTA, show_spinner=False)(pesquisas_da_conta)
+_servicos_da_conta = st.cache_data(ttl=TTL_DESCOBERTA_S, max_entries=MAX_ENTRADAS_DESCOBERTA, show_spinner=False)(servicos_da_conta)
+
+@st.cache_resource
+def gerenciador_downloads():
+    return GerenciadorDownloads()
+
+def carregar_resultado(job):
+    """Aponta a sessão para o resultado de um job (só a chave; os dados continuam no repositório)."""
+    st.session_state["dados_chave"] = job.chave_dados
+    st.session_state["dados_versao"] = job.chave_dados
+    st.session_state["export_cache"] = None
+    st.session_state["estatisticas_download"] = job.estatisticas
+    st.session_state["relatorio_upload"] = job.relatorio_upload
+    st.session_state["telemetria"] = job.telemetria.copia()   # a sessão mede as próprias etapas
+    if job.token: st.session_state["token"] = job.token
+
+def somar_resultado(job):
+    """Soma o resultado de um job aos dados carregados; respostas já presentes (pela chave) não entram de novo."""
+    repositorio = gerenciador_downloads().repositorio
+    atual, novo = repositorio.obter(st.session_state["dados_chave"]), job.dados
+    if atual is None or novo is None: return 0
+    telemetria = st.session_state["telemetria"] or Telemetria()
+    with telemetria.etapa("mesclagem"):
+        df, cubo, indice, novas = mesclar_relatorios(atual.df, atual.cubo, atual.indice, novo.df)
+        # A soma é um conjunto novo (os dois originais continuam intactos para outras sessões)
+        if novas: st.session_state["dados_chave"] = repositorio.registrar(df, cubo, API_URL_SECRET, indice).chave
+    telemetria.contar("linhas", novo.linhas - novas, "duplicadas_mesclagem")
+    st.session_state["dados_versao"] = st.session_state["dados_chave"]
+    st.session_state["export_cache"] = None
+    st.session_state["telemetria"] = telemetria
+    if job.token: st.session_state["token"] = job.token
+    return novas
+
+def painel_telemetria(telemetria):
+    """Tempos por etapa, latência das requisições e contagem de linhas, com exportação JSON/Prometheus."""
+    dados = telemetria.para_dict()
+    if not dados["etapas"]:
+        st.caption("Sem medições ainda.")
+        return
+    etapas = pd.DataFrame([{"Etapa": k, "Execuções": e["execucoes"], "Segundos": e["segundos"],
+                            "Média (ms)": round(e["segundos"] / e["execucoes"] * 1000, 1)} for k, e in dados["etapas"].items()])
+    st.caption("Tempos somados por etapa (requisições, JSON e dedup rodam em paralelo e podem passar do tempo total do download).")
+    st.dataframe(etapas.sort_values("Segundos", ascending=False), hide_index=True, use_container_width=True)
+
+    c1, c2 = st.columns(2)
+    lat = dados["histogramas"].get("requisicao_segundos")
+    if lat:
+        rotulos = [f"≤ {lim}s" for lim in lat["limites"]] + [f"> {lat['limites'][-1]}s"]
+        c1.markdown(f"**Latência das requisições** (média {lat['soma'] / lat['total'] * 1000:.0f} ms)")
+        c1.bar_chart(pd.Series(lat["baldes"], index=pd.CategoricalIndex(rotulos, categories=rotulos, ordered=True)))
+    contadores = dados["contadores"]
+    with c2:
+        if "bytes_recebidos" in contadores: st.metric("Recebido da API", f"{contadores['bytes_recebidos'][''] / 2**20:.1f} MB")
+        if "requisicoes" in contadores:
+            st.caption("Requisições por status: " + " | ".join(f"{k}: {v}" for k, v in sorted(contadores["requisicoes"].items())))
+        pags = dados["histogramas"].get("paginas_por_fatia")
+        if pags: st.caption(f"Páginas por fatia: média {pags['soma'] / pags['total']:.1f} em {pags['total']} fatias")
+        if "linhas" in contadores:
+            st.dataframe(pd.DataFrame(sorted(contadores["linhas"].items()), columns=["Linhas", "Qtd"]), hide_index=True, use_container_width=True)
+
+    d1, d2 = st.columns(2)
+    d1.download_button("⬇️ Telemetria (JSON)", telemetria.para_json(), file_name="telemetria_satisfador.json", mime="application/json", use_container_width=True)
+    d2.download_button("⬇️ Telemetria (Prometheus)", telemetria.para_prometheus(), file_name="telemetria_satisfador.prom", mime="text/plain", use_container_width=True)
+
+@st.fragment
+def painel_tendencia(contas):
+    """Tendência de meses/anos lida só do rollup diário em disco (nenhuma resposta é carregada)."""
+    c1, c2, c3, c4 = st.columns([2, 1, 1, 1])
+    hoje = datetime.today().date()
+    intervalo = c1.date_input("Período da tendência", (hoje - timedelta(days=DIAS_TENDENCIA_PADRAO), hoje))
+    rotulo = c2.radio("Agrupar por", list(PERIODOS_TENDENCIA), index=2, horizontal=True)
+    setor = c3.selectbox("Setor", ["TODOS"] + list(SETORES_AGENTES.keys()) + ["OUTROS"], key="tendencia_setor")
+    comparar = c4.toggle("Comparar com o ano anterior")
+    if len(intervalo) != 2 or not contas: return
+    d_ini, d_fim = intervalo
+
+    def serie(a, b):
+        conn = abrir_cache()
+        try: rollup = ler_rollup(conn, contas, a, b)
+        finally: conn.close()
+        return tendencia(rollup[mascara_filtros(rollup, [], setor, [])], PERIODOS_TENDENCIA[rotulo])
+
+    trend = serie(d_ini, d_fim)
+    if trend.empty:
+        st.caption("Sem histórico local para o período: cada download concluído alimenta o rollup diário.")
+        return
+    trend['Série'] = "Período"
+    if comparar:
+        um_ano = pd.DateOffset(years=1)
+        anterior = serie((pd.Timestamp(d_ini) - um_ano).date(), (pd.Timestamp(d_fim) - um_ano).date())
+        anterior['Dia'] += um_ano
+        anterior['Série'] = "Ano anterior"
+        trend = pd.concat([trend, anterior], ignore_index=True)
+    fig = px.line(trend, x='Dia', y='Sat', color='Série', markers=True, hover_data=['Total'],
+                  color_discrete_map={"Período": '#2563eb', "Ano anterior": '#94a3b8'})
+    fig.update_layout(yaxis_range=[0, 105], height=320, legend_title_text="")
+    st.plotly_chart(fig, use_container_width=True)
+    st.caption(f"{int(trend.loc[trend['Série'] == 'Período', 'Total'].sum()):,} respostas no rollup".replace(",", "."))
 
 # ==============================================================================
 # INTERFACE
@@ -334,11 +204,17 @@ else:
         uploaded_files = st.file_uploader("CSV/Excel (Matrix)", accept_multiple_files=True, type=['csv', 'xlsx'])
         st.markdown("---")
         limit_page = st.slider("Itens por Requisição", 50, 500, 100, 50)
+        max_workers = st.slider("Requisições Simultâneas", 1, 16, MAX_WORKERS_PADRAO, 1)
+        usar_cache = st.checkbox("Usar cache local (dias fechados)", value=True)
         st.divider()
         if st.button("Limpar Tudo / Sair"):
             st.session_state["token"] = None
             st.session_state["app_access"] = False
-            st.session_state["df_raw_cache"] = None
+            st.session_state["dados_chave"] = None
+            st.session_state["export_cache"] = None
+            st.session_state["tabela_cache"] = None
+            for id_job in st.session_state["jobs"]: gerenciador_downloads().remover(id_job)
+            st.session_state["jobs"] = []
             st.rerun()
 
     st.title("Painel de Satisfação (Big Data)")
@@ -358,11 +234,16 @@ else:
             
         if st.button("🔎 Buscar Pesquisas Disponíveis", use_container_width=True):
             if contas_sel:
-                st.session_state["pesquisas_list"] = listar_pesquisas(API_URL_SECRET, st.session_state["token"], contas_sel, ini, fim)
-                st.session_state["servicos_list"] = listar_servicos_api(API_URL_SECRET, st.session_state["token"], contas_sel[0], ini, fim)
+                with st.spinner("Mapeando pesquisas..."):
+                    st.session_state["pesquisas_list"] = listar_pesquisas(API_URL_SECRET, st.session_state["token"], contas_sel, ini, fim, consulta=_pesquisas_da_conta)
+                with st.spinner("Carregando serviços das contas..."):
+                    st.session_state["servicos_list"], usou_fallback = listar_servicos_api(API_URL_SECRET, st.session_state["token"], contas_sel, ini, fim, consulta=_servicos_da_conta)
+                if usou_fallback: st.toast("⚠️ Serviços carregados (Base: últimos 30 dias)", icon="ℹ️")
                 
                 # Reseta o cache de dados se mudar a busca
-                st.session_state["df_raw_cache"] = None 
+                st.session_state["dados_chave"] = None
+                st.session_state["export_cache"] = None
+                st.session_state["tabela_cache"] = None
                 
                 if not st.session_state["pesquisas_list"]: 
                     st.toast("Nenhuma pesquisa encontrada!", icon="⚠️")
@@ -370,6 +251,9 @@ else:
                     st.toast(f"Encontradas: {len(st.session_state['pesquisas_list'])} pesquisas e {len(st.session_state['servicos_list'])} serviços.", icon="✅")
             else: st.toast("Selecione uma conta.", icon="⚠️")
 
+    with st.expander("📈 Tendência de longo prazo (histórico local)"):
+        painel_tendencia(contas_sel)
+
     if st.session_state["pesquisas_list"] or uploaded_files:
         with st.container(border=True):
             st.markdown("#### 1. Coleta de Dados")
@@ -382,64 +266,98 @@ else:
             # Botão para BAIXAR (não gera relatório ainda, só baixa)
             baixar = st.button("⬇️ Baixar Dados e Processar", type="primary", use_container_width=True)
 
-        # Lógica de Download e Cache
+        # Download em segundo plano: o job roda fora do script e a sessão continua livre para explorar
         if baixar:
-            raw_data = []
-            if p_ids:
-                raw_data = baixar_dados_fracionado(API_URL_SECRET, st.session_state["token"], contas_sel, p_ids, ini, fim, limit_page)
-            
-            if uploaded_files:
-                for u in uploaded_files:
-                    try:
-                        fname = u.name.lower()
-                        if "servico_de_interne" in fname or ("internet" in fname and "experiencia" not in fname): continue
-                        if u.name.endswith('.xlsx'): df_t = pd.read_excel(u)
-                        else: df_t = pd.read_csv(u)
-                        df_t.columns = df_t.columns.str.strip()
-                        mapa = {'Opção': 'nom_valor', 'Agente': 'nom_agente', 'Data': 'dat_resposta', 
-                                'Protocolo': 'num_protocolo', 'Resposta': 'nom_resposta', 'Conta': 'conta_origem_id',
-                                'Serviço': 'nom_servico'} 
-                        df_t = df_t.rename(columns=mapa)
-                        for col in ['nom_valor', 'nom_agente', 'dat_resposta', 'num_protocolo']:
-                            if col not in df_t.columns: df_t[col] = None
-                        df_t['dat_resposta'] = pd.to_datetime(df_t['dat_resposta'], dayfirst=True, errors='coerce')
-                        raw_data.extend(df_t.to_dict(orient='records'))
-                    except: pass
-            
-            if raw_data:
-                # Processamento Inicial
-                df = pd.DataFrame(raw_data)
-                df['Nota'] = pd.to_numeric(df['nom_valor'], errors='coerce').fillna(-1) 
-                df = df[df['Nota'] >= 0] 
-                df['Nota'] = df['Nota'].astype(int)
-                
-                df['Data'] = pd.to_datetime(df['dat_resposta'])
-                df['Dia'] = df['Data'].dt.strftime('%d/%m')
-                df['Agente'] = df['nom_agente'].apply(normalizar_nome)
-                df['Setor'] = df['Agente'].apply(get_setor)
-                df['Nome_Conta'] = df['conta_origem_id'].map(CONTAS_FIXAS).fillna("Outra")
-                df['Link'] = df['num_protocolo'].apply(criar_link_atendimento)
-                if 'nom_servico' not in df.columns: df['Serviço'] = "N/A"
-                else: df['Serviço'] = df['nom_servico'].astype(str).str.upper().replace('NAN', 'N/A')
-                
-                # Salva no Cache para não perder ao interagir com filtros
-                st.session_state["df_raw_cache"] = df
-                st.rerun() # Recarrega a página para mostrar os filtros abaixo
-            else:
-                st.error("Nenhum dado encontrado para o período/pesquisa.")
+            if p_ids or uploaded_files:
+                autenticador = AutenticadorApi(API_URL_SECRET, API_USER_SECRET, API_PASS_SECRET, st.session_state["token"])
+                partes = [f"{ini:%d/%m/%Y} a {fim:%d/%m/%Y}"]
+                if p_ids: partes.append(f"{len(contas_sel)} conta(s), {len(p_ids)} pesquisa(s)")
+                if uploaded_files: partes.append(f"{len(uploaded_files)} arquivo(s)")
+                job = gerenciador_downloads().enfileirar(
+                    " | ".join(partes), base_url=API_URL_SECRET, lista_contas=contas_sel, lista_pesquisas=p_ids,
+                    d_ini=ini, d_fim=fim, limit_size=limit_page, max_workers=max_workers, usar_cache=usar_cache,
+                    autenticador=autenticador, arquivos=[(u.name, u.getvalue()) for u in uploaded_files or []])
+                st.session_state["jobs"].append(job.id)
+                st.toast("Download enviado para a fila.", icon="⏳")
+            else: st.toast("Selecione ao menos uma pesquisa.", icon="⚠️")
+
+        gerenciador = gerenciador_downloads()
+        st.session_state["jobs"] = [j for j in st.session_state["jobs"] if gerenciador.job(j)]
+        havia_ativos = any(gerenciador.job(j).ativo for j in st.session_state["jobs"])
+
+        @st.fragment(run_every=INTERVALO_POLL_S if havia_ativos else None)
+        def painel_downloads():
+            jobs = [job for job in map(gerenciador.job, st.session_state["jobs"]) if job]
+            if not jobs: return
+            for job in reversed(jobs):
+                with st.container(border=True):
+                    c1, c2 = st.columns([4, 1])
+                    c1.markdown(f"**{job.descricao}** — {job.status}")
+                    if job.ativo:
+                        c1.progress(job.progresso, text=job.mensagem)
+                        if c2.button("✖️ Cancelar", key=f"cancelar_{job.id}", use_container_width=True): job.cancelar.set()
+                        continue
+                    c1.caption(job.mensagem)
+                    if job.status == "Concluído":
+                        # Sem dados na tela ainda: carrega direto
+                        automatico = st.session_state["dados_chave"] is None and st.session_state.get("job_carregado") != job.id
+                        if automatico or c2.button("📊 Carregar", key=f"carregar_{job.id}", use_container_width=True):
+                            carregar_resultado(job)
+                            st.session_state["job_carregado"] = job.id
+                            st.rerun()
+                        # Somar: junta este download aos dados na tela (períodos/fontes sobrepostos contam uma vez)
+                        if st.session_state["dados_chave"] is not None and st.session_state.get("job_carregado") != job.id \
+                                and c2.button("➕ Somar", key=f"somar_{job.id}", use_container_width=True):
+                            novas = somar_resultado(job)
+                            st.toast(f"{novas:,} respostas novas somadas ({len(job.df) - novas:,} já estavam carregadas).".replace(",", "."), icon="➕")
+                            st.rerun()
+                    elif job.relatorio_upload:
+                        c1.dataframe(pd.DataFrame(job.relatorio_upload), hide_index=True, use_container_width=True)
+                    if c2.button("🗑️ Remover", key=f"remover_{job.id}", use_container_width=True):
+                        gerenciador.remover(job.id)
+                        st.rerun()
+            # Terminou tudo: um rerun completo desliga a atualização automática
+            if havia_ativos and not any(job.ativo for job in jobs): st.rerun()
+
+        painel_downloads()
 
         # --- SEGUNDA ETAPA: FILTROS E RELATÓRIOS (SÓ APARECE SE TIVER DADOS) ---
-        if st.session_state["df_raw_cache"] is not None:
-            df = st.session_state["df_raw_cache"].copy()
+        conjunto = gerenciador.repositorio.obter(st.session_state["dados_chave"])
+        if st.session_state["dados_chave"] and conjunto is None:
+            st.session_state["dados_chave"] = None
+            st.warning("Os dados carregados expiraram no servidor. Baixe o relatório de novo.")
+        if conjunto is not None:
+            # Sem cópias: os filtros abaixo só montam máscaras sobre o DataFrame compartilhado (somente leitura)
+            df = conjunto.df
+            cubo = conjunto.cubo
             
             st.divider()
             
+            est = st.session_state["estatisticas_download"]
+            if est:
+                st.caption(f"📡 {est['requisicoes']} requisições à API | {est['fatias_cache']} fatias do cache local | "
+                           f"Janelas fixas de {DIAS_JANELA_PADRAO} dias: ~{est['requisicoes_janela_fixa']} | "
+                           + (f"Economizadas: **{est['requisicoes_economizadas']}**" if est['requisicoes_economizadas'] >= 0 else f"A mais: **{-est['requisicoes_economizadas']}**"))
+                if est.get("fatias_incompletas"):
+                    st.warning(f"⚠️ {est['fatias_incompletas']} fatia(s) não puderam ser baixadas após {MAX_TENTATIVAS} tentativas. "
+                               "Clique em **Baixar Dados e Processar** de novo para retomar só o que faltou.")
+            
+            rel = st.session_state["relatorio_upload"]
+            if rel:
+                with st.expander(f"📂 Arquivos importados: {sum(r['Linhas'] for r in rel)} linhas", expanded=any(r['Status'] != 'OK' for r in rel)):
+                    st.dataframe(pd.DataFrame(rel), hide_index=True, use_container_width=True)
+            
+            if st.session_state["telemetria"] is None: st.session_state["telemetria"] = Telemetria()
+            telemetria = st.session_state["telemetria"]
+            with st.expander("🩺 Diagnóstico de desempenho"):
+                painel_telemetria(telemetria)
+            
             # --- AQUI ESTÁ A "CAIXINHA" DE PLANTÃO QUE VOCÊ PEDIU ---
             with st.expander("🛑 Configuração de Plantão / Exclusões Manuais (Clique para Expandir)", expanded=True):
                 st.info("Selecione abaixo os agentes que estão de PLANTÃO ou FÉRIAS para removê-los deste relatório.")
                 
                 # Lista única de todos os agentes encontrados nos dados baixados
-                todos_agentes = sorted(df['Agente'].unique())
+                todos_agentes = sorted(cubo['Agente'].unique().tolist())
                 
                 # O usuario marca quem quer TIRAR
                 agentes_plantao = st.multiselect(
@@ -450,7 +368,6 @@ else:
                 
                 # Filtra o DataFrame removendo os marcados
                 if agentes_plantao:
-                    df = df[~df['Agente'].isin(agentes_plantao)]
                     st.caption(f"Removendo {len(agentes_plantao)} agentes da análise.")
 
             # Filtros de Negócio (Setor/Serviço)
@@ -465,26 +382,21 @@ else:
                     opcoes_servico = st.session_state.get("servicos_list", [])
                     servicos_sel = st.multiselect("Filtrar Serviços (API)", options=opcoes_servico, placeholder="Selecione serviços específicos (Opcional)")
 
-            # Aplicação dos Filtros de Negócio
-            df_final = df.copy()
-            
-            if setor_sel != "TODOS":
-                servicos_vinculados = df_final[df_final['Setor'] == setor_sel]['Serviço'].unique()
-                is_official = (df_final['Setor'] == setor_sel)
-                is_orphan_doing_service = (df_final['Setor'] == 'OUTROS') & (df_final['Serviço'].isin(servicos_vinculados))
-                df_final = df_final[is_official | is_orphan_doing_service]
-            
-            if servicos_sel:
-                df_final = df_final[df_final['Serviço'].isin(servicos_sel)]
+            # Aplicação dos Filtros de Negócio (KPIs e gráficos saem do cubo)
+            with telemetria.etapa("consulta"):
+                cubo_final = cubo[mascara_filtros(cubo, agentes_plantao, setor_sel, servicos_sel)]
+                total, prom, csat, media = indicadores(cubo_final)
             
             # --- EXIBIÇÃO DOS RESULTADOS ---
-            if df_final.empty:
+            if total == 0:
                 st.warning("Sem dados para este conjunto de filtros (ou todos os agentes foram removidos).")
             else:
-                total = len(df_final)
-                prom = len(df_final[df_final['Nota'] >= 8])
-                csat = (prom / total * 100)
-                media = df_final['Nota'].mean()
+                # Linhas filtradas só são recalculadas quando os dados ou os filtros mudam
+                chave_filtro = (st.session_state["dados_versao"], tuple(sorted(agentes_plantao)), setor_sel, tuple(sorted(servicos_sel)))
+                tabela = st.session_state["tabela_cache"]
+                if tabela is None or tabela["chave_filtro"] != chave_filtro:
+                    filtradas = mascara_filtros(df, agentes_plantao, setor_sel, servicos_sel).to_numpy().nonzero()[0]
+                    tabela = st.session_state["tabela_cache"] = {"chave_filtro": chave_filtro, "filtradas": filtradas, "chave": None}
 
                 st.markdown("### Resultados")
                 k1, k2, k3, k4 = st.columns(4)
@@ -495,19 +407,16 @@ else:
                 
                 st.divider()
                 
-                trend = df_final.groupby('Dia').agg(Total=('Nota', 'count'), Prom=('Nota', lambda x: (x>=8).sum())).reset_index()
-                trend['Sat'] = (trend['Prom']/trend['Total']*100).round(2)
+                trend = tendencia(cubo_final)
                 fig = px.line(trend, x='Dia', y='Sat', markers=True, title="Evolução", text='Sat')
                 fig.update_traces(line_color='#2563eb', textposition="top center")
-                fig.update_layout(yaxis_range=[0, 115], height=300)
+                fig.update_layout(yaxis_range=[0, 115], height=300, xaxis_tickformat="%d/%m")
                 st.plotly_chart(fig, use_container_width=True)
                 
                 st.divider()
                 
                 col_rank, col_pie = st.columns([2, 1])
-                rank = df_final.groupby('Agente').agg(Qtd=('Nota', 'count'), Prom=('Nota', lambda x: (x>=8).sum()), Media=('Nota', 'mean')).reset_index()
-                rank['CSAT'] = (rank['Prom']/rank['Qtd']*100).round(2)
-                rank = rank.sort_values('CSAT', ascending=False)
+                rank = ranking_agentes(cubo_final)
                 
                 with col_rank:
                     st.dataframe(
@@ -521,18 +430,59 @@ else:
                     st.plotly_chart(fig_pie, use_container_width=True)
                 
                 st.subheader("Base de Dados")
-                st.dataframe(df_final[['Data', 'Nome_Conta', 'Setor', 'Agente', 'Serviço', 'Nota', 'nom_resposta', 'Link']], hide_index=True, use_container_width=True, column_config={"Link": st.column_config.LinkColumn("Ver", display_text="Abrir"), "Data": st.column_config.DatetimeColumn(format="D/M/Y H:m")})
+                # Paginação no servidor: busca e ordenação em pandas, só a página visível vai para o navegador
+                c_busca, c_ord, c_dir, c_tam = st.columns([3, 2, 1, 1])
+                busca = c_busca.text_input("Buscar", placeholder="Buscar agente, serviço, conta, resposta ou protocolo...", label_visibility="collapsed").strip()
+                coluna_ord = c_ord.selectbox("Ordenar por", ['Data', 'Nota', 'Agente', 'Setor', 'Serviço', 'Nome_Conta'], label_visibility="collapsed")
+                crescente = c_dir.toggle("Crescente")
+                tamanho = c_tam.selectbox("Linhas por página", TAMANHOS_PAGINA, index=1, label_visibility="collapsed")
+                
+                chave_tabela = (chave_filtro, busca, coluna_ord, crescente)
+                if tabela["chave"] != chave_tabela:
+                    posicoes = tabela["filtradas"]
+                    if busca: posicoes = posicoes[mascara_busca(df, busca)[posicoes]]
+                    tabela["posicoes"] = ordenar_posicoes(df, posicoes, coluna_ord, crescente)
+                    tabela["chave"] = chave_tabela
+                    st.session_state["tabela_pagina"] = 1
+                
+                total_linhas = len(tabela["posicoes"])
+                n_paginas = max(1, -(-total_linhas // tamanho))
+                st.session_state["tabela_pagina"] = min(st.session_state.get("tabela_pagina", 1), n_paginas)
+                c_pag, c_info = st.columns([1, 3])
+                pagina = c_pag.number_input("Página", min_value=1, max_value=n_paginas, step=1, key="tabela_pagina", label_visibility="collapsed")
+                inicio = (pagina - 1) * tamanho
+                c_info.caption(f"Linhas {min(inicio + 1, total_linhas)}–{min(inicio + tamanho, total_linhas)} de {total_linhas} | Página {pagina} de {n_paginas}")
+                st.dataframe(tabela_exportacao(df.iloc[tabela["posicoes"][inicio:inicio + tamanho]], API_URL_SECRET), hide_index=True, use_container_width=True, column_config={"Link": st.column_config.LinkColumn("Ver", display_text="Abrir"), "Data": st.column_config.DatetimeColumn(format="D/M/Y H:m")})
                 
                 st.divider()
                 
-                # Excel com fallback seguro
-                excel_data = gerar_excel(rank[['Agente', 'CSAT', 'Qtd', 'Media']], df_final)
+                # Exportação sob demanda: só gera quando pedido, e reaproveita enquanto os filtros não mudarem
+                c_fmt, c_gerar = st.columns([2, 1])
+                formato = c_fmt.selectbox("Formato do arquivo", list(FORMATOS_EXPORT.keys()), label_visibility="collapsed")
+                extensao, mime = FORMATOS_EXPORT[formato]
+                chave = chave_exportacao(st.session_state["dados_versao"], sorted(agentes_plantao), setor_sel, sorted(servicos_sel), formato)
+                export = st.session_state["export_cache"]
                 
-                st.download_button(
-                    label="📥 Baixar Relatório Excel (Completo)",
-                    data=excel_data,
-                    file_name=f"relatorio_satisfacao_{datetime.today().strftime('%Y-%m-%d')}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    use_container_width=True
-                )
+                if export is None or export["chave"] != chave:
+                    if c_gerar.button("⚙️ Gerar Arquivo", use_container_width=True):
+                        with st.spinner("Gerando arquivo..."):
+                            try:
+                                filtradas = tabela["filtradas"]
+                                df_final = df if len(filtradas) == len(df) else df.iloc[filtradas]
+                                with telemetria.etapa("exportacao"):
+                                    dados = gerar_exportacao(formato, rank[['Agente', 'CSAT', 'Qtd', 'Media']], df_final, API_URL_SECRET)
+                                export = st.session_state["export_cache"] = {"chave": chave, "dados": dados}
+                            except ImportError:
+                                st.error("Formato indisponível neste servidor (dependência não instalada).")
+                            except ValueError as e:
+                                st.error(str(e))
+                
+                if export is not None and export["chave"] == chave:
+                    st.download_button(
+                        label=f"📥 Baixar Relatório ({formato})",
+                        data=export["dados"],
+                        file_name=f"relatorio_satisfacao_{datetime.today().strftime('%Y-%m-%d')}.{extensao}",
+                        mime=mime,
+                        use_container_width=True
+                    )
 
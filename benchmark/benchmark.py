@@ -0,0 +1,232 @@
+"""
+Benchmark do pipeline download -> processamento -> agregação -> exportação contra a API sintética
+(servidor_matrix.py), sem tocar na produção.
+
+Para cada volume mede tempo, vazão e pico de memória de cada etapa. O download passa de verdade
+pelo HTTP até --limite-download respostas; acima disso o DataFrame bruto é gerado direto (mesmo
+esquema do BufferRespostas) para medir as etapas seguintes com até milhões de linhas.
+
+Exemplos:
+    python benchmark/benchmark.py
+    python benchmark/benchmark.py --volumes 10000 100000 1000000 5000000 --latencia 0.05 --saida base.json
+    python benchmark/benchmark.py --comparar base.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+# O cache em disco do benchmark não pode misturar com o do app
+os.environ.setdefault("SATISFADOR_CACHE_DB", os.path.join(tempfile.mkdtemp(prefix="bench_satisfador_"), "cache.db"))
+
+import numpy as np
+import pandas as pd
+
+import motor
+from servidor_matrix import ConfigServidor, iniciar_em_processo, AGENTES, SERVICOS, RESPOSTAS, TOKEN_VALIDO
+
+VOLUMES_PADRAO = [10_000, 100_000, 1_000_000]
+LIMITE_DOWNLOAD = 200_000       # Acima disso o bruto é sintetizado (o HTTP local vira o gargalo)
+REPETICOES_CONSULTA = 20        # Filtros aplicados sobre o cubo para medir a latência de interação
+
+
+class MedidorMemoria:
+    """Pico de memória de um trecho: RSS amostrado em thread (Linux) ou tracemalloc nos demais."""
+    def __init__(self, intervalo=0.005):
+        self.intervalo = intervalo
+        self.usar_rss = os.path.exists("/proc/self/statm")
+        self.pagina = os.sysconf("SC_PAGE_SIZE") if self.usar_rss else 1
+
+    def _rss(self):
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * self.pagina
+
+    def __enter__(self):
+        if not self.usar_rss:
+            tracemalloc.start()
+            return self
+        self.inicial = self.pico = self._rss()
+        self.parar = threading.Event()
+
+        def amostrar():
+            while not self.parar.wait(self.intervalo):
+                self.pico = max(self.pico, self._rss())
+        self.thread = threading.Thread(target=amostrar, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.usar_rss:
+            self.mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+            return
+        self.parar.set()
+        self.thread.join()
+        self.mb = (max(self.pico, self._rss()) - self.inicial) / 2**20
+
+
+def medir(resultados, etapa, linhas, func, *args, **kwargs):
+    """Roda func, guarda tempo/vazão/pico de memória da etapa e devolve o resultado de func."""
+    with MedidorMemoria() as mem:
+        t0 = time.perf_counter()
+        saida = func(*args, **kwargs)
+        segundos = time.perf_counter() - t0
+    resultados[etapa] = {"segundos": round(segundos, 4), "linhas": int(linhas),
+                         "linhas_por_s": round(linhas / segundos) if segundos else None, "pico_mb": round(mem.mb, 1)}
+    return saida
+
+
+def bruto_sintetico(config):
+    """DataFrame bruto (COLUNAS_BRUTAS) com a mesma distribuição do servidor, gerado em numpy."""
+    por_combinacao = config.dias * config.por_dia
+    partes = []
+    for conta in config.contas:
+        for pesquisa in config.pesquisas:
+            idx = np.arange(por_combinacao, dtype=np.uint64)
+            dia_ord = config.inicio.toordinal() + (idx // config.por_dia)
+            i = idx % config.por_dia
+            h = (i * 2654435761 + dia_ord * 40503 + int(conta) * 97 + int(pesquisa) * 31 + config.semente) % 2**32
+            datas = (pd.to_datetime(config.inicio) + pd.to_timedelta((idx // config.por_dia).astype(np.int64), unit="D")
+                     + pd.to_timedelta(((h >> 4) % 24).astype(np.int64), unit="h")
+                     + pd.to_timedelta(((h >> 12) % 60).astype(np.int64), unit="m")
+                     + pd.to_timedelta(((h >> 16) % 60).astype(np.int64), unit="s"))
+            sem_protocolo = (h % 10_000) < config.taxa_sem_protocolo * 10_000
+            protocolos = pd.Series(np.char.add(f"{conta}{pesquisa}", idx.astype(str)), dtype=object)
+            protocolos[sem_protocolo] = ""
+            partes.append(pd.DataFrame({
+                "nom_valor": ((h >> 8) % 11).astype(str).astype(object),
+                "dat_resposta": datas.strftime("%Y-%m-%d %H:%M:%S").astype(object),
+                "nom_agente": np.array(AGENTES, dtype=object)[h % len(AGENTES)],
+                "num_protocolo": protocolos,
+                "nom_resposta": np.array(RESPOSTAS, dtype=object)[(h >> 20) % len(RESPOSTAS)],
+                "conta_origem_id": conta,
+                "nom_servico": np.array(SERVICOS, dtype=object)[(h >> 24) % len(SERVICOS)],
+            }, columns=motor.COLUNAS_BRUTAS))
+    return pd.concat(partes, ignore_index=True).head(config.respostas)
+
+
+def consultar(cubo, agentes, setores, servicos):
+    """Uma rodada de interação: filtros sobre o cubo + KPIs, tendência e ranking (o que cada rerun faz)."""
+    for k in range(REPETICOES_CONSULTA):
+        filtrado = cubo[motor.mascara_filtros(cubo, agentes[:k % 3], setores[k % len(setores)], servicos[:k % 2])]
+        motor.indicadores(filtrado)
+        motor.tendencia(filtrado)
+        motor.ranking_agentes(filtrado)
+
+
+def exportar_todos(resultados, df, cubo, formatos):
+    rank = motor.ranking_agentes(cubo)[['Agente', 'CSAT', 'Qtd', 'Media']]
+    for nome in formatos:
+        extensao = motor.FORMATOS_EXPORT[nome][0]
+        if extensao == "xlsx" and len(df) > motor.LIMITE_LINHAS_EXCEL:
+            resultados[f"exportacao_{extensao}"] = {"ignorado": f"acima de {motor.LIMITE_LINHAS_EXCEL} linhas"}
+            continue
+        try: dados = medir(resultados, f"exportacao_{extensao}", len(df), motor.gerar_exportacao, nome, rank, df)
+        except ImportError as e:
+            resultados[f"exportacao_{extensao}"] = {"ignorado": f"dependência ausente ({e.name})"}
+            continue
+        resultados[f"exportacao_{extensao}"]["bytes"] = len(dados)
+
+
+def rodar_volume(volume, args):
+    config = ConfigServidor(volume, dias=args.dias, contas=args.contas, pesquisas=args.pesquisas,
+                            latencia=args.latencia, taxa_erro=args.taxa_erro, limite_maximo=args.limite_maximo)
+    resultados = {}
+    if volume <= args.limite_download:
+        url, parar = iniciar_em_processo(config)
+        try:
+            bruto = medir(resultados, "download", volume, motor.baixar_dados_fracionado,
+                          url, TOKEN_VALIDO, list(config.contas), list(config.pesquisas), config.inicio, config.fim,
+                          args.itens, max_workers=args.workers, req_por_segundo=args.req_por_segundo, usar_cache=False)
+        finally:
+            parar()
+        est = bruto.attrs.get("estatisticas_download") or {}
+        resultados["download"].update({"linhas": len(bruto), "requisicoes": est.get("requisicoes"),
+                                       "fatias_incompletas": est.get("fatias_incompletas"),
+                                       "telemetria": bruto.attrs.get("telemetria")})
+        segundos = resultados["download"]["segundos"]
+        resultados["download"]["linhas_por_s"] = round(len(bruto) / segundos) if segundos else None
+    else:
+        url = "http://127.0.0.1"
+        bruto = medir(resultados, "geracao_sintetica", volume, bruto_sintetico, config)
+
+    df = medir(resultados, "processamento", len(bruto), motor.processar_dados, bruto)
+    del bruto
+    resultados["processamento"]["memoria_df_mb"] = round(df.memory_usage(deep=True).sum() / 2**20, 1)
+    cubo = medir(resultados, "agregacao", len(df), motor.montar_cubo, df)
+    resultados["agregacao"]["linhas_cubo"] = len(cubo)
+    if cubo["Qtd"].sum() != len(df):
+        raise RuntimeError(f"Cubo com {cubo['Qtd'].sum()} respostas para {len(df)} linhas do relatório")
+
+    agentes = cubo["Agente"].value_counts().index.tolist()
+    setores = ["TODOS"] + list(motor.SETORES_AGENTES) + ["OUTROS"]
+    servicos = sorted(cubo["Serviço"].unique().tolist())
+    medir(resultados, "consulta", len(cubo) * REPETICOES_CONSULTA, consultar, cubo, agentes, setores, servicos)
+    resultados["consulta"]["ms_por_interacao"] = round(resultados["consulta"]["segundos"] / REPETICOES_CONSULTA * 1000, 2)
+
+    exportar_todos(resultados, df, cubo, args.formatos)
+    return resultados
+
+
+def imprimir(volume, resultados, base=None):
+    print(f"\n=== {volume:,} respostas ===".replace(",", "."))
+    print(f"{'etapa':<20}{'segundos':>10}{'linhas/s':>14}{'pico MB':>10}  {'vs base':>8}")
+    for etapa, r in resultados.items():
+        if "ignorado" in r:
+            print(f"{etapa:<20}{'-':>10}{'-':>14}{'-':>10}  {r['ignorado']}")
+            continue
+        delta = ""
+        anterior = (base or {}).get(str(volume), {}).get(etapa, {}).get("segundos")
+        if anterior: delta = f"{(r['segundos'] / anterior - 1) * 100:+.0f}%"
+        print(f"{etapa:<20}{r['segundos']:>10.3f}{r['linhas_por_s'] or 0:>14,}{r['pico_mb']:>10.1f}  {delta:>8}".replace(",", "."))
+
+
+def main(argv=None):
+    nomes_formato = {ext: nome for nome, (ext, _) in motor.FORMATOS_EXPORT.items()}
+    parser = argparse.ArgumentParser(description="Benchmark offline do Satisfador contra a API Matrix sintética.")
+    parser.add_argument("--volumes", type=int, nargs="+", default=VOLUMES_PADRAO, help="Respostas por rodada (10 mil a 5 milhões)")
+    parser.add_argument("--limite-download", type=int, default=LIMITE_DOWNLOAD, help="Maior volume baixado pelo HTTP")
+    parser.add_argument("--dias", type=int, default=30)
+    parser.add_argument("--contas", nargs="+", default=["1", "15"])
+    parser.add_argument("--pesquisas", nargs="+", default=["35"])
+    parser.add_argument("--latencia", type=float, default=0.0, help="Segundos de latência por requisição no servidor")
+    parser.add_argument("--taxa-erro", type=float, default=0.0, help="Fração de respostas 500/429 do servidor")
+    parser.add_argument("--limite-maximo", type=int, default=500, help="Maior página aceita pelo servidor")
+    parser.add_argument("--itens", type=int, default=500, help="Itens por requisição pedidos pelo app")
+    parser.add_argument("--workers", type=int, default=motor.MAX_WORKERS_PADRAO)
+    parser.add_argument("--req-por-segundo", type=float, default=0, help="Limitador do app (0 = sem limite)")
+    parser.add_argument("--formatos", nargs="+", choices=list(nomes_formato), default=list(nomes_formato))
+    parser.add_argument("--saida", help="Grava os resultados em JSON")
+    parser.add_argument("--comparar", help="JSON de uma rodada anterior para comparar os tempos")
+    args = parser.parse_args(argv)
+    args.formatos = [nomes_formato[f] for f in args.formatos]
+    motor.BACKOFF_BASE = min(motor.BACKOFF_BASE, 0.05)    # erros injetados não devem medir o sleep do backoff
+
+    base = None
+    if args.comparar:
+        with open(args.comparar) as f: base = json.load(f)["volumes"]
+
+    relatorio = {
+        "ambiente": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                     "cpus": os.cpu_count(), "plataforma": platform.platform()},
+        "parametros": {k: v for k, v in vars(args).items() if k not in ("saida", "comparar")},
+        "volumes": {},
+    }
+    for volume in args.volumes:
+        resultados = rodar_volume(volume, args)
+        relatorio["volumes"][str(volume)] = resultados
+        imprimir(volume, resultados, base)
+
+    if args.saida:
+        with open(args.saida, "w") as f: json.dump(relatorio, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados em {args.saida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Servidor local que imita a API REST v2 do Matrix para medir o app sem tocar na produção.
+
+Rotas: POST /rest/v2/authuser, GET /rest/v2/relPesquisa, /rest/v2/relAtEstatistico e
+/rest/v2/RelPesqAnalitico. As respostas são sintéticas e determinísticas (mesma configuração,
+mesmos dados), geradas sob demanda página a página: 5 milhões de respostas não ocupam memória.
+
+Uso avulso (para apontar o app ou a CLI para ele):
+    python benchmark/servidor_matrix.py --porta 8765 --respostas 1000000 --latencia 0.05 --taxa-erro 0.02
+"""
+import argparse
+import gzip
+import json
+import math
+import multiprocessing
+import random
+import threading
+import time
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+TOKEN_VALIDO = "token-benchmark"
+AGENTES = ["CARLA", "BARBOSA", "VALERIO", "MILENA", "ELOISA", "RODRIGO", "ALICE", "RILDYVAN", "GRANJA", "MARIA",
+           "LARISSA", "TARCISIO", "ANA LUIZA", "HENRIQUE", "ZECA", "RECEPÇÃO"]
+SERVICOS = ["SUPORTE", "FINANCEIRO", "CANCELAMENTO", "COMERCIAL", "NEGOCIAÇÃO"]
+PESQUISAS = {"35": "Satisfação Atendimento", "43": "Satisfação V3", "5": "Pesquisa NPS"}
+RESPOSTAS = ["Excelente", "Bom", "Regular", "Ruim"]
+
+
+class ConfigServidor:
+    """Volume e comportamento do servidor. respostas é o total do período, somando contas e pesquisas."""
+    def __init__(self, respostas=100_000, inicio=None, dias=30, contas=("1", "15"), pesquisas=("35",),
+                 latencia=0.0, taxa_erro=0.0, limite_maximo=500, taxa_sem_protocolo=0.01, semente=42, gzip=True):
+        self.respostas = respostas
+        self.inicio = inicio or (date.today() - timedelta(days=dias + 2))
+        self.dias = dias
+        self.contas = tuple(str(c) for c in contas)
+        self.pesquisas = tuple(str(p) for p in pesquisas)
+        self.latencia = latencia
+        self.taxa_erro = taxa_erro
+        self.limite_maximo = limite_maximo
+        self.taxa_sem_protocolo = taxa_sem_protocolo
+        self.semente = semente
+        self.gzip = gzip                # Compacta quando o cliente aceita (como o servidor real atrás do proxy)
+
+    @property
+    def fim(self):
+        return self.inicio + timedelta(days=self.dias - 1)
+
+    @property
+    def por_dia(self):
+        """Respostas por dia de cada par conta x pesquisa."""
+        return math.ceil(self.respostas / (self.dias * len(self.contas) * len(self.pesquisas)))
+
+
+def gerar_resposta(config, conta, pesquisa, dia, i):
+    """A i-ésima resposta do dia (sempre a mesma para os mesmos argumentos)."""
+    h = (i * 2654435761 + dia.toordinal() * 40503 + int(conta) * 97 + int(pesquisa) * 31 + config.semente) % 2**32
+    sem_protocolo = (h % 10_000) < config.taxa_sem_protocolo * 10_000
+    return {
+        "num_protocolo": "" if sem_protocolo else f"{conta}{pesquisa}{dia:%y%m%d}{i:06d}",
+        "nom_agente": AGENTES[h % len(AGENTES)],
+        "nom_valor": str((h >> 8) % 11),
+        "dat_resposta": f"{dia:%Y-%m-%d} {(h >> 4) % 24:02d}:{(h >> 12) % 60:02d}:{(h >> 16) % 60:02d}",
+        "nom_resposta": RESPOSTAS[(h >> 20) % len(RESPOSTAS)],
+        "nom_servico": SERVICOS[(h >> 24) % len(SERVICOS)],
+        "des_observacao": "Campo que o relatório não usa e o servidor real também manda.",
+        "cod_contato": h,
+    }
+
+
+def pagina_analitico(config, conta, pesquisa, d_ini, d_fim, page, limit):
+    """Blocos (um por serviço) da página pedida do RelPesqAnalitico; lista vazia depois do fim."""
+    if conta not in config.contas or pesquisa not in config.pesquisas: return []
+    d_ini, d_fim = max(d_ini, config.inicio), min(d_fim, config.fim)
+    total = max(0, (d_fim - d_ini).days + 1) * config.por_dia
+    blocos = {}
+    for idx in range((page - 1) * limit, min(page * limit, total)):
+        dia = d_ini + timedelta(days=idx // config.por_dia)
+        resp = gerar_resposta(config, conta, pesquisa, dia, idx % config.por_dia)
+        servico = resp.pop("nom_servico")
+        if servico not in blocos:
+            blocos[servico] = {"cod_pergunta": 1, "nom_pergunta": "Como você avalia o atendimento?",
+                               "nom_servico": servico, "respostas": []}
+        blocos[servico]["respostas"].append(resp)
+    return list(blocos.values())
+
+
+class ManipuladorMatrix(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Cabeçalho e corpo saem em escritas separadas: sem TCP_NODELAY o keep-alive esbarra no ACK atrasado (~40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args): pass
+
+    def _enviar(self, corpo, status=200, cabecalhos=()):
+        dados = json.dumps(corpo).encode()
+        compactar = self.server.config.gzip and "gzip" in self.headers.get("Accept-Encoding", "")
+        if compactar: dados = gzip.compress(dados, compresslevel=5)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if compactar: self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(dados)))
+        for chave, valor in cabecalhos: self.send_header(chave, valor)
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if urlparse(self.path).path != "/rest/v2/authuser": return self._enviar({"success": False}, 404)
+        self._enviar({"success": True, "result": {"token": TOKEN_VALIDO}})
+
+    def do_GET(self):
+        config = self.server.config
+        if config.latencia: time.sleep(config.latencia)
+        sorteio = random.random()
+        if sorteio < config.taxa_erro / 2: return self._enviar({"error": "Erro interno"}, 500)
+        if sorteio < config.taxa_erro: return self._enviar({"error": "Muitas requisições"}, 429, [("Retry-After", "1")])
+        if self.headers.get("Authorization") != f"Bearer {TOKEN_VALIDO}": return self._enviar({"error": "Token inválido"}, 401)
+
+        rota = urlparse(self.path)
+        q = {k: v[0] for k, v in parse_qs(rota.query).items()}
+        page = max(1, int(q.get("page", 1)))
+        limit = min(max(1, int(q.get("limit", 100))), config.limite_maximo)
+        inicio = (page - 1) * limit
+
+        if rota.path == "/rest/v2/relPesquisa":
+            rows = [{"cod_pesquisa": int(p), "nom_pesquisa": PESQUISAS.get(p, f"Pesquisa {p}")} for p in config.pesquisas]
+            return self._enviar({"rows": rows[inicio:inicio + limit]})
+        if rota.path == "/rest/v2/relAtEstatistico":
+            rows = [{"agrupador": s, "qtd_atendimentos": 0} for s in SERVICOS + ["ATENDIMENTO AUTOMATICO"]]
+            return self._enviar({"rows": rows[inicio:inicio + limit]})
+        if rota.path == "/rest/v2/RelPesqAnalitico":
+            d_ini = date.fromisoformat(q["data_inicial"][:10])
+            d_fim = date.fromisoformat(q["data_final"][:10])
+            return self._enviar(pagina_analitico(config, q.get("id_conta", ""), q.get("pesquisa", ""), d_ini, d_fim, page, limit))
+        self._enviar({"error": "Rota desconhecida"}, 404)
+
+
+def criar_servidor(config, porta=0):
+    servidor = ThreadingHTTPServer(("127.0.0.1", porta), ManipuladorMatrix)
+    servidor.daemon_threads = True
+    servidor.config = config
+    return servidor
+
+
+def _servir(config, porta, fila):
+    servidor = criar_servidor(config, porta)
+    fila.put(servidor.server_address[1])
+    servidor.serve_forever()
+
+
+def iniciar_em_processo(config, porta=0):
+    """
+    Sobe o servidor em outro processo (fora do GIL de quem mede). Retorna (url, parar).
+    """
+    fila = multiprocessing.Queue()
+    processo = multiprocessing.Process(target=_servir, args=(config, porta, fila), daemon=True)
+    processo.start()
+    porta = fila.get(timeout=30)
+
+    def parar():
+        processo.terminate()
+        processo.join()
+    return f"http://127.0.0.1:{porta}", parar
+
+
+def iniciar_em_thread(config, porta=0):
+    """Sobe o servidor numa thread deste processo. Retorna (url, parar)."""
+    servidor = criar_servidor(config, porta)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    def parar():
+        servidor.shutdown()
+        servidor.server_close()
+    return f"http://127.0.0.1:{servidor.server_address[1]}", parar
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API Matrix sintética para testes de desempenho.")
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--respostas", type=int, default=100_000)
+    parser.add_argument("--dias", type=int, default=30)
+    parser.add_argument("--contas", nargs="+", default=["1", "15"])
+    parser.add_argument("--pesquisas", nargs="+", default=["35"])
+    parser.add_argument("--latencia", type=float, default=0.0, help="Segundos por requisição")
+    parser.add_argument("--taxa-erro", type=float, default=0.0, help="Fração de respostas 500/429")
+    parser.add_argument("--limite-maximo", type=int, default=500, help="Maior 'limit' aceito por página")
+    parser.add_argument("--sem-gzip", action="store_true", help="Nunca compacta as respostas")
+    args = parser.parse_args(argv)
+
+    config = ConfigServidor(args.respostas, dias=args.dias, contas=args.contas, pesquisas=args.pesquisas,
+                            latencia=args.latencia, taxa_erro=args.taxa_erro, limite_maximo=args.limite_maximo,
+                            gzip=not args.sem_gzip)
+    servidor = criar_servidor(config, args.porta)
+    print(f"API Matrix sintética em http://127.0.0.1:{servidor.server_address[1]} "
+          f"({config.respostas} respostas de {config.inicio:%d/%m/%Y} a {config.fim:%d/%m/%Y}; token {TOKEN_VALIDO})")
+    try: servidor.serve_forever()
+    except KeyboardInterrupt: pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Relatórios de satisfação pela linha de comando (sem navegador), usando o mesmo motor da interface.
+
+Exemplos:
+    python cli.py --contas 1 15 --pesquisas 35 43 --periodo 2026-09-01:2026-09-30 --saida relatorios/
+    python cli.py --contas 1 15 --por-conta --periodo 2026-08-01:2026-08-31 --periodo 2026-09-01:2026-09-30 --formato parquet
+
+Cada combinação de período x grupo de contas vira um relatório; eles baixam em paralelo
+(--paralelos) dividindo o mesmo pool de requisições. Credenciais: --url/--usuario/--senha ou as
+variáveis SATISFADOR_API_URL, SATISFADOR_API_USER e SATISFADOR_API_PASS.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+from motor import (
+    MAX_WORKERS_PADRAO, MAX_JOBS_SIMULTANEOS, FORMATOS_EXPORT,
+    autenticar, listar_pesquisas, AutenticadorApi, GerenciadorDownloads,
+    mascara_filtros, indicadores, ranking_agentes, gerar_exportacao,
+)
+
+FORMATOS_CLI = {extensao: nome for nome, (extensao, _) in FORMATOS_EXPORT.items()}
+
+
+def data_iso(texto):
+    return datetime.strptime(texto, "%Y-%m-%d").date()
+
+
+def periodo(texto):
+    try:
+        ini, fim = (data_iso(p) for p in texto.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"período inválido: {texto!r} (use AAAA-MM-DD:AAAA-MM-DD)")
+    if fim < ini: raise argparse.ArgumentTypeError(f"período invertido: {texto!r}")
+    return ini, fim
+
+
+def criar_parser():
+    parser = argparse.ArgumentParser(description="Gera relatórios de satisfação do Matrix sem a interface.")
+    parser.add_argument("--contas", nargs="+", required=True, help="IDs das contas (ex.: 1 15)")
+    parser.add_argument("--pesquisas", nargs="+", help="IDs das pesquisas (padrão: todas as encontradas no período)")
+    parser.add_argument("--periodo", type=periodo, action="append", required=True,
+                        help="AAAA-MM-DD:AAAA-MM-DD; repita para vários períodos")
+    parser.add_argument("--por-conta", action="store_true", help="Um relatório por conta em vez de um por período")
+    parser.add_argument("--saida", default=".", help="Pasta dos arquivos gerados")
+    parser.add_argument("--formato", choices=list(FORMATOS_CLI), default="xlsx")
+    parser.add_argument("--arquivos", nargs="+", default=[], help="CSV/Excel exportados do Matrix somados a cada relatório")
+    parser.add_argument("--excluir-agentes", nargs="+", default=[], help="Agentes de plantão/férias fora do relatório")
+    parser.add_argument("--setor", default="TODOS")
+    parser.add_argument("--servicos", nargs="+", default=[])
+    parser.add_argument("--itens", type=int, default=100, help="Itens por requisição")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS_PADRAO, help="Requisições simultâneas por relatório")
+    parser.add_argument("--paralelos", type=int, default=MAX_JOBS_SIMULTANEOS, help="Relatórios baixando ao mesmo tempo")
+    parser.add_argument("--sem-cache", action="store_true", help="Ignora o cache local de dias fechados")
+    parser.add_argument("--telemetria", action="store_true", help="Grava as medições de cada relatório (.json e .prom)")
+    parser.add_argument("--url", default=os.environ.get("SATISFADOR_API_URL", ""))
+    parser.add_argument("--usuario", default=os.environ.get("SATISFADOR_API_USER", ""))
+    parser.add_argument("--senha", default=os.environ.get("SATISFADOR_API_PASS", ""))
+    return parser
+
+
+def salvar_relatorio(job, args, caminho):
+    """Aplica os filtros ao resultado do job e grava o arquivo. Retorna (total, csat)."""
+    cubo = job.cubo[mascara_filtros(job.cubo, args.excluir_agentes, args.setor, args.servicos)]
+    total, _, csat, _ = indicadores(cubo)
+    if not total: return total, csat
+    mascara = mascara_filtros(job.df, args.excluir_agentes, args.setor, args.servicos)
+    rank = ranking_agentes(cubo)
+    with job.telemetria.etapa("exportacao"):
+        dados = gerar_exportacao(FORMATOS_CLI[args.formato], rank[['Agente', 'CSAT', 'Qtd', 'Media']], job.df[mascara], args.url)
+    with open(caminho, "wb") as f: f.write(dados)
+    return total, csat
+
+
+def main(argv=None):
+    args = criar_parser().parse_args(argv)
+    if not args.url and not args.arquivos:
+        sys.exit("Informe --url (ou SATISFADOR_API_URL) e/ou --arquivos.")
+
+    token = autenticar(args.url, args.usuario, args.senha) if args.url else None
+    if args.url and not token: sys.exit("Erro de conexão/autenticação.")
+
+    arquivos = []
+    for caminho in args.arquivos:
+        with open(caminho, "rb") as f: arquivos.append((os.path.basename(caminho), f.read()))
+
+    os.makedirs(args.saida, exist_ok=True)
+    grupos = [[c] for c in args.contas] if args.por_conta else [args.contas]
+    gerenciador = GerenciadorDownloads(max_jobs=max(1, args.paralelos))
+    relatorios = []
+    for ini, fim in args.periodo:
+        for contas in grupos:
+            pesquisas = args.pesquisas
+            if not args.url: pesquisas = []
+            elif pesquisas is None:
+                pesquisas = [p["id"] for p in listar_pesquisas(args.url, token, contas, ini, fim)]
+            descricao = f"contas {'-'.join(contas)} | {ini:%d/%m/%Y} a {fim:%d/%m/%Y}"
+            job = gerenciador.enfileirar(
+                descricao, base_url=args.url, lista_contas=contas, lista_pesquisas=pesquisas,
+                d_ini=ini, d_fim=fim, limit_size=args.itens, max_workers=args.workers, usar_cache=not args.sem_cache,
+                autenticador=AutenticadorApi(args.url, args.usuario, args.senha, token), arquivos=arquivos)
+            nome = f"relatorio_satisfacao_{'-'.join(contas)}_{ini:%Y-%m-%d}_{fim:%Y-%m-%d}.{args.formato}"
+            relatorios.append((job, os.path.join(args.saida, nome)))
+
+    # Cada relatório é gravado assim que o download dele termina
+    pendentes = list(relatorios)
+    falhas = 0
+    while pendentes:
+        time.sleep(1)
+        for job, caminho in [r for r in pendentes if not r[0].ativo]:
+            pendentes.remove((job, caminho))
+            if job.status == "Concluído":
+                try:
+                    total, csat = salvar_relatorio(job, args, caminho)
+                    if total: print(f"{job.descricao}: {total} respostas, CSAT {csat:.2f}% -> {caminho}")
+                    else: print(f"{job.descricao}: sem dados para os filtros")
+                except ValueError as e:
+                    falhas += 1
+                    print(f"{job.descricao}: {e}", file=sys.stderr)
+                if args.telemetria:
+                    with open(f"{caminho}.telemetria.json", "w", encoding="utf-8") as f: f.write(job.telemetria.para_json())
+                    with open(f"{caminho}.telemetria.prom", "w", encoding="utf-8") as f: f.write(job.telemetria.para_prometheus())
+            else:
+                falhas += 1
+                print(f"{job.descricao}: {job.status} - {job.mensagem}", file=sys.stderr)
+            est = job.estatisticas
+            if est and est.get("fatias_incompletas"):
+                print(f"{job.descricao}: {est['fatias_incompletas']} fatia(s) incompleta(s); rode de novo para retomar.", file=sys.stderr)
+    return 1 if falhas else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
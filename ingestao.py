@@ -0,0 +1,114 @@
+"""
+Leitura em lote dos arquivos exportados do Matrix (CSV/Excel) no esquema bruto do app (COLUNAS_BRUTAS).
+
+Fica fora do app.py (sem Streamlit) para que os processos de leitura de .xlsx possam importar
+este módulo sem executar a interface.
+"""
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pandas as pd
+
+# Esquema projetado do DataFrame bruto (API e upload)
+COLUNAS_BRUTAS = ["nom_valor", "dat_resposta", "nom_agente", "num_protocolo", "nom_resposta", "conta_origem_id", "nom_servico"]
+
+MAPA_COLUNAS_UPLOAD = {
+    'Opção': 'nom_valor', 'Agente': 'nom_agente', 'Data': 'dat_resposta',
+    'Protocolo': 'num_protocolo', 'Resposta': 'nom_resposta', 'Conta': 'conta_origem_id',
+    'Serviço': 'nom_servico',
+}
+COLUNAS_OBRIGATORIAS = ['Opção', 'Agente']
+LINHAS_POR_BLOCO_CSV = 200_000
+MAX_PROCESSOS_XLSX = max(1, min(4, os.cpu_count() or 1))
+
+try:
+    import pyarrow  # noqa: F401  (motor rápido do read_csv)
+    MOTOR_CSV = "pyarrow"
+except ImportError:
+    MOTOR_CSV = "c"
+
+
+def arquivo_ignorado(nome):
+    fname = nome.lower()
+    return "servico_de_interne" in fname or ("internet" in fname and "experiencia" not in fname)
+
+
+def _normalizar(df_t):
+    df_t = df_t.rename(columns=MAPA_COLUNAS_UPLOAD).reindex(columns=COLUNAS_BRUTAS)
+    df_t['dat_resposta'] = pd.to_datetime(df_t['dat_resposta'], dayfirst=True, errors='coerce')
+    # Conta lida como número (1, 1.0) precisa casar com as chaves texto de CONTAS_FIXAS
+    conta = df_t['conta_origem_id']
+    if pd.api.types.is_numeric_dtype(conta): conta = conta.astype("Int64")
+    df_t['conta_origem_id'] = conta.astype("string")
+    return df_t
+
+
+def _colunas_uteis(colunas):
+    """Colunas do arquivo (com espaços) que interessam, já com o nome limpo. Sem nota ou agente, o arquivo não serve."""
+    uteis = {c: c.strip() for c in colunas if str(c).strip() in MAPA_COLUNAS_UPLOAD}
+    faltando = [c for c in COLUNAS_OBRIGATORIAS if c not in uteis.values()]
+    if faltando: raise ValueError(f"colunas não reconhecidas (faltando {', '.join(faltando)})")
+    return uteis
+
+
+def ler_csv(conteudo):
+    cabecalho = pd.read_csv(io.BytesIO(conteudo), nrows=0).columns
+    uteis = _colunas_uteis(cabecalho)
+    if MOTOR_CSV == "pyarrow":
+        df_t = pd.read_csv(io.BytesIO(conteudo), usecols=list(uteis), engine="pyarrow")
+    else:
+        blocos = pd.read_csv(io.BytesIO(conteudo), usecols=list(uteis), chunksize=LINHAS_POR_BLOCO_CSV)
+        df_t = pd.concat(blocos, ignore_index=True)
+    return _normalizar(df_t.rename(columns=uteis))
+
+
+def ler_xlsx(conteudo):
+    df_t = pd.read_excel(io.BytesIO(conteudo))
+    uteis = _colunas_uteis(df_t.columns)
+    return _normalizar(df_t[list(uteis)].rename(columns=uteis))
+
+
+def ler_arquivo(nome, conteudo):
+    return ler_xlsx(conteudo) if nome.lower().endswith('.xlsx') else ler_csv(conteudo)
+
+
+def ler_uploads(arquivos):
+    """
+    Lê vários arquivos em paralelo: .xlsx em processos (o parser é Python puro), .csv em threads.
+    arquivos: lista de (nome, bytes). Retorna (frames, relatorio), onde relatorio traz uma linha
+    por arquivo com as linhas lidas ou o erro.
+    """
+    relatorio = []
+    frames = []
+    n_xlsx = sum(1 for nome, _ in arquivos if nome.lower().endswith('.xlsx') and not arquivo_ignorado(nome))
+    futuros = []
+    # Um único .xlsx não compensa subir um processo: vai para as threads. "spawn" porque quem chama é
+    # uma thread de um servidor com várias threads, e fork nesse cenário pode travar o processo filho.
+    pool_proc = ProcessPoolExecutor(max_workers=min(MAX_PROCESSOS_XLSX, n_xlsx),
+                                    mp_context=multiprocessing.get_context("spawn")) if n_xlsx > 1 else None
+    pool_thr = ThreadPoolExecutor(max_workers=4)
+    try:
+        for nome, conteudo in arquivos:
+            if arquivo_ignorado(nome):
+                futuros.append((nome, None))
+            else:
+                pool = pool_proc if (pool_proc and nome.lower().endswith('.xlsx')) else pool_thr
+                futuros.append((nome, pool.submit(ler_arquivo, nome, conteudo)))
+
+        for nome, fut in futuros:
+            if fut is None:
+                relatorio.append({"Arquivo": nome, "Linhas": 0, "Status": "Ignorado (pesquisa de internet/serviço)"})
+                continue
+            try:
+                df_t = fut.result()
+                frames.append(df_t)
+                relatorio.append({"Arquivo": nome, "Linhas": len(df_t), "Status": "OK"})
+            except Exception as e:
+                relatorio.append({"Arquivo": nome, "Linhas": 0, "Status": f"Erro: {e}"})
+    finally:
+        pool_thr.shutdown()
+        if pool_proc: pool_proc.shutdown()
+
+    return frames, relatorio
@@ -0,0 +1,1654 @@
+"""
+Motor do relatório de satisfação, sem Streamlit: autenticação, descoberta, download fracionado
+do RelPesqAnalitico, processamento, agregações de CSAT e exportação.
+
+Usado pela interface (app.py) e pela linha de comando (cli.py).
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from datetime import datetime, date, timedelta
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+import requests
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+
+from ingestao import COLUNAS_BRUTAS, ler_uploads
+
+try:
+    from pyarrow import feather     # conjuntos despejados da memória vão para Arrow IPC
+except ImportError:
+    feather = None
+
+try:
+    import orjson   # decodifica direto dos bytes, várias vezes mais rápido que o json da biblioteca padrão
+    decodificar_json = orjson.loads
+except ImportError:
+    decodificar_json = json.loads
+
+# IDs CRÍTICOS (Filtros de Exclusão)
+ID_PESQUISA_V3 = "43"
+ID_PERGUNTA_IGNORAR_V3 = "40"
+
+CONTAS_FIXAS = {
+    "1":  "117628-ATEL", "15": "ATEL Telecom", "14": "ATELAtivo-V2",
+    "13": "ClienteInterno_V2", "12": "TráfegoPago_V2", "11": "SUPORTE ATIVO",
+    "9":  "Pascoa", "7":  "Tráfego pago", "5":  "CLIENTE INTERNO", "3":  "LABORATÓRIO", "15": "ATEL Telecom - Disparos", "16": "ATEL- Lucas Valões"
+}
+
+SETORES_AGENTES = {
+    'CANCELAMENTO': ['BARBOSA', 'ELOISA', 'LARISSA', 'EDUARDO', 'CAMILA', 'SAMARA'],
+    'NEGOCIACAO': ['CARLA', 'LENK', 'ANA LUIZA', 'JULIETTI', 'RODRIGO', 'MONALISA', 'RAMOM', 'EDNAEL', 'LETICIA', 'RITA', 'MARIANA', 'FLAVIA S', 'URI', 'CLARA', 'WANDERSON', 'APARECIDA', 'CRISTINA', 'CAIO', 'LUKAS'],
+    'SUPORTE': ['VALERIO', 'TARCISIO', 'GRANJA', 'ALICE', 'FERNANDO', 'SANTOS', 'RENAN', 'FERREIRA', 'HUEMILLY', 'LOPES', 'LAUDEMILSON', 'RAYANE', 'LAYS', 'JORGE', 'LIGIA', 'ALESSANDRO', 'GEIBSON', 'ROBERTO', 'OLIVEIRA', 'MAURÍCIO', 'AVOLO', 'CLEBER', 'ROMERIO', 'JUNIOR', 'ISABELA', 'WAGNER', 'CLAUDIA', 'ANTONIO', 'JOSE', 'LEONARDO', 'KLEBSON', 'OZENAIDE'],
+    'NRC': ['RILDYVAN', 'MILENA', 'ALVES', 'MONICKE', 'AYLA', 'MARIANY', 'EDUARDA', 'MENEZES', 'JUCIENNY', 'MARIA', 'ANDREZA', 'LUZILENE', 'IGO', 'AIDA', 'CARIBÉ', 'MICHELLY', 'ADRIA', 'ERICA', 'HENRIQUE', 'SHYRLEI', 'ANNA', 'JULIA', 'FERNANDES']
+}
+
+# --- DOWNLOAD CONCORRENTE ---
+MAX_WORKERS_PADRAO = 4          # Requisições simultâneas ao RelPesqAnalitico
+LIMITE_REQ_POR_SEGUNDO = 8      # Teto de requisições por segundo por host
+
+# --- DOWNLOADS EM SEGUNDO PLANO ---
+MAX_JOBS_SIMULTANEOS = 2        # Downloads executando ao mesmo tempo (os demais aguardam na fila)
+MAX_WORKERS_POOL = 16           # Threads de fatia compartilhadas por todos os downloads do processo
+VALIDADE_JOB_H = 6              # Downloads finalizados e não removidos somem depois disso
+
+# --- DADOS COMPARTILHADOS (entre sessões) ---
+LIMITE_MEMORIA_DADOS_MB = int(os.environ.get("SATISFADOR_LIMITE_DADOS_MB", 1024))  # Acima disso, os menos usados vão para o disco
+DADOS_DIR = os.environ.get("SATISFADOR_DADOS_DIR", "dados_satisfacao")            # Arquivos Arrow dos conjuntos despejados
+VALIDADE_PEDIDO_ABERTO_S = 900  # Relatório que inclui hoje/ontem é reaproveitado por 15 min (depois baixa de novo)
+VALIDADE_DADOS_H = 24           # Arquivos em disco mais velhos que isso são apagados
+
+# --- JANELAS ADAPTATIVAS ---
+MAX_PAGINAS = 100               # Teto de páginas por janela; acima disso a janela é dividida
+DIAS_JANELA_PADRAO = 20         # Janela quando ainda não se conhece o volume da conta
+DIAS_JANELA_MAX = 92            # Janela máxima para contas com pouco volume
+OCUPACAO_ALVO = 0.5             # Fração do teto de páginas que uma janela deve ocupar
+
+# --- RESILIÊNCIA ---
+MAX_TENTATIVAS = 5              # Tentativas por requisição (erros de rede, 429 e 5xx)
+BACKOFF_BASE = 1.0              # Segundos; dobra a cada tentativa (com jitter)
+BACKOFF_MAX = 30.0
+CHECKPOINT_VALIDADE_H = 24      # Checkpoints de downloads interrompidos valem por este tempo
+
+# --- CACHE DE DESCOBERTA (Processo) ---
+TTL_DESCOBERTA_S = 3600         # Pesquisas/serviços por conta e período ficam em cache por 1 hora
+MAX_ENTRADAS_DESCOBERTA = 512   # Teto de consultas guardadas (as menos usadas saem primeiro)
+MAX_WORKERS_DESCOBERTA = 8      # Contas consultadas ao mesmo tempo na descoberta
+LIMITE_DESCOBERTA = 100         # Itens por página no relPesquisa
+LIMITE_DESCOBERTA_SERVICOS = 500
+
+# --- TRANSPORTE HTTP ---
+CONEXOES_POR_HOST = MAX_WORKERS_POOL + MAX_WORKERS_DESCOBERTA   # Conexões keep-alive guardadas por host
+CABECALHOS_HTTP = {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+
+# --- TELEMETRIA ---
+# Baldes (limites superiores) dos histogramas e nome do rótulo de cada contador
+BALDES_TELEMETRIA = {
+    "requisicao_segundos": (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    "paginas_por_fatia": (1, 2, 5, 10, 25, 50, 100),
+}
+ROTULOS_TELEMETRIA = {"requisicoes": "status", "linhas": "destino"}
+
+# --- CACHE LOCAL (Disco) ---
+CACHE_DB_PATH = os.environ.get("SATISFADOR_CACHE_DB", "cache_satisfacao.db")
+DIAS_CACHE_ABERTOS = 2          # Hoje e ontem sempre são baixados de novo
+
+# Campos da resposta da API que o relatório realmente usa (o resto é descartado na página)
+CAMPOS_RESPOSTA = ("num_protocolo", "nom_agente", "nom_valor", "dat_resposta", "nom_resposta", "nom_servico", "servico")
+# Colunas acumuladas no download: o esquema bruto + a pergunta (só entra na chave de deduplicação) e a pesquisa
+COLUNAS_BUFFER = COLUNAS_BRUTAS + ["cod_pergunta", "id_pesquisa"]
+# Esquema compacto guardado na sessão (strings de baixa cardinalidade viram category)
+TIPOS_RELATORIO = {
+    "Data": "datetime64[ns]", "Dia": "category", "conta_origem_id": "category", "Nome_Conta": "category",
+    "Setor": "category", "Agente": "category", "Serviço": "category",
+    "nom_resposta": "category", "Cod_Atendimento": "category", "Chave": "uint64", "Chave_Base": "uint64",
+    "Pesquisa": "category",     # vazia nas linhas de upload
+}
+DIMENSOES_CUBO = ["Dia", "Agente", "Setor", "Serviço", "conta_origem_id"]
+
+# --- TENDÊNCIA DE LONGO PRAZO (rollup diário no cache local) ---
+PERIODOS_TENDENCIA = {"Diária": "D", "Semanal": "W", "Mensal": "M"}
+DIAS_TENDENCIA_PADRAO = 365
+
+# --- TABELA (Base de Dados) ---
+TAMANHOS_PAGINA = [25, 50, 100, 250, 500]
+COLUNAS_BUSCA = ['Nome_Conta', 'Setor', 'Agente', 'Serviço', 'nom_resposta', 'Cod_Atendimento']
+
+# --- EXPORTAÇÃO ---
+COLUNAS_EXPORT = ['Data', 'Nome_Conta', 'Setor', 'Agente', 'Serviço', 'Nota', 'nom_resposta', 'Link']   # Link sai de Cod_Atendimento
+LINHAS_POR_BLOCO = 50_000
+LIMITE_LINHAS_EXCEL = 1_048_575  # Linhas de dados que cabem numa planilha (fora o cabeçalho)
+FORMATOS_EXPORT = {
+    "Excel (.xlsx)": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV compactado (.csv.gz)": ("csv.gz", "application/gzip"),
+    "Parquet (.parquet)": ("parquet", "application/vnd.apache.parquet"),
+}
+
+# --- AUXILIARES ---
+def normalizar_nome(nome):
+    return str(nome).strip().upper() if nome and str(nome) != "nan" else "DESCONHECIDO"
+
+# Um padrão compilado por setor (na ordem do dicionário: o primeiro setor que casar vence)
+_PADROES_SETOR = [(setor, re.compile("|".join(re.escape(a) for a in lista))) for setor, lista in SETORES_AGENTES.items()]
+
+def normalizar_servico(servico):
+    nome = str(servico).upper() if servico is not None and not pd.isna(servico) else "NAN"
+    return "N/A" if nome == "NAN" else nome
+
+def get_setor(agente):
+    nome = normalizar_nome(agente)
+    for setor, padrao in _PADROES_SETOR:
+        if padrao.search(nome): return setor
+    return 'OUTROS'
+
+def mapear_unicos(serie, func):
+    """Aplica func uma vez por valor distinto e espalha o resultado de volta nas linhas (como category)."""
+    codes, uniques = pd.factorize(serie, use_na_sentinel=False)
+    valores = pd.Categorical([func(u) for u in uniques])
+    return pd.Series(valores[codes], index=serie.index)
+
+def dominio_atendimento(base_url=""):
+    domain = base_url.replace("/rest/v2", "").replace("https://", "") if base_url else "ateltelecom.matrixdobrasil.ai"
+    if "api" in domain: domain = "ateltelecom.matrixdobrasil.ai"
+    return domain
+
+def codigo_atendimento(protocolo):
+    """Código do atendimento: os 7 últimos caracteres do protocolo, como texto (None sem protocolo válido)."""
+    if pd.isna(protocolo) or str(protocolo) in ("0", "nan", "None", ""): return None
+    return str(protocolo).strip().replace('.0', '')[-7:]
+
+def codigos_atendimento(protocolos):
+    """codigo_atendimento de cada linha (uma vez por protocolo distinto), em category."""
+    codes, uniques = pd.factorize(protocolos)
+    cod_codes, categorias = pd.factorize(np.array([codigo_atendimento(p) for p in uniques], dtype=object))
+    codigos = np.where(codes >= 0, cod_codes[codes] if len(cod_codes) else codes, -1)
+    return pd.Series(pd.Categorical.from_codes(codigos, categorias.astype(str)), index=protocolos.index)
+
+def links_atendimento(codigos, base_url=""):
+    """URL de cada atendimento. Montada só para as linhas exibidas ou exportadas, nunca guardada."""
+    return f"https://{dominio_atendimento(base_url)}/atendimento/view/cod_atendimento/" + codigos.astype("string") + "/readonly/true#atendimento-div"
+
+def processar_dados(df):
+    """Transforma o DataFrame bruto (COLUNAS_BRUTAS) no DataFrame compacto do relatório (TIPOS_RELATORIO)."""
+    codes, valores = pd.factorize(df['nom_valor'], use_na_sentinel=False)
+    notas = pd.to_numeric(pd.Series(valores, dtype=object), errors='coerce').fillna(-1).to_numpy()[codes]
+    df = df[notas >= 0]
+
+    out = pd.DataFrame(index=df.index)
+    out['Data'] = pd.to_datetime(df['dat_resposta'])
+    codes, dias = pd.factorize(out['Data'].dt.normalize(), use_na_sentinel=False)
+    out['Dia'] = pd.Categorical(pd.DatetimeIndex(dias))[codes]    # data de verdade: ordena e não mistura meses
+    out['conta_origem_id'] = df['conta_origem_id'].astype(object).astype('category')
+    out['Nome_Conta'] = out['conta_origem_id'].map(CONTAS_FIXAS).astype(object).fillna("Outra")
+    out['Agente'] = mapear_unicos(df['nom_agente'], normalizar_nome)
+    out['Setor'] = mapear_unicos(out['Agente'], get_setor)
+    if 'nom_servico' not in df.columns: out['Serviço'] = "N/A"
+    else: out['Serviço'] = mapear_unicos(df['nom_servico'], normalizar_servico)
+    out['Nota'] = pd.to_numeric(notas[notas >= 0].astype(int), downcast='integer')  # int8 para notas 0-10
+    out['nom_resposta'] = df['nom_resposta']
+    out['Cod_Atendimento'] = codigos_atendimento(df['num_protocolo'])
+    out['Pesquisa'] = df['id_pesquisa'] if 'id_pesquisa' in df.columns else None
+    # Chaves de deduplicação: as que vieram do download/upload ou, se faltarem, calculadas aqui
+    if {'chave', 'chave_base'} <= set(df.columns) and not df[['chave', 'chave_base']].isna().any().any():
+        out['Chave'] = df['chave'].to_numpy(dtype=np.uint64)
+        out['Chave_Base'] = df['chave_base'].to_numpy(dtype=np.uint64)
+    else:
+        out['Chave'], out['Chave_Base'] = chaves_dedup(df)
+    return out.astype(TIPOS_RELATORIO).reset_index(drop=True)
+
+def montar_cubo(df, dimensoes=DIMENSOES_CUBO):
+    """Agrega o DataFrame do relatório em Qtd / Prom (nota >= 8) / Soma de notas por dimensoes (DIMENSOES_CUBO)."""
+    base = pd.DataFrame({c: df[c] for c in dimensoes})
+    base["Qtd"] = np.ones(len(df), dtype="int64")
+    base["Prom"] = (df["Nota"] >= 8).astype("int64")
+    base["Soma"] = df["Nota"].astype("int64")
+    # dropna=False: upload sem conta ou com data ilegível continua contando (a dimensão fica vazia)
+    return base.groupby(dimensoes, observed=True, dropna=False)[["Qtd", "Prom", "Soma"]].sum().reset_index()
+
+def mascara_filtros(df, agentes_excluidos, setor_sel, servicos_sel):
+    """Máscara dos filtros de plantão/setor/serviço. Serve tanto para as linhas quanto para o cubo."""
+    mascara = pd.Series(True, index=df.index)
+    if agentes_excluidos:
+        mascara &= ~df['Agente'].isin(agentes_excluidos)
+
+    if setor_sel != "TODOS":
+        is_official = (df['Setor'] == setor_sel)
+        servicos_vinculados = df.loc[mascara & is_official, 'Serviço'].unique()
+        is_orphan_doing_service = (df['Setor'] == 'OUTROS') & (df['Serviço'].isin(servicos_vinculados))
+        mascara &= is_official | is_orphan_doing_service
+
+    if servicos_sel:
+        mascara &= df['Serviço'].isin(servicos_sel)
+    return mascara
+
+def mascara_busca(df, texto, colunas=COLUNAS_BUSCA):
+    """Linhas com o texto (sem diferenciar maiúsculas) em alguma das colunas. Em category só as categorias são varridas."""
+    mascara = np.zeros(len(df), dtype=bool)
+    for c in colunas:
+        serie = df[c]
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            achou = serie.cat.categories.astype(str).str.contains(texto, case=False, regex=False)
+            mascara |= np.isin(serie.cat.codes.to_numpy(), np.flatnonzero(achou))
+        else:
+            mascara |= serie.str.contains(texto, case=False, regex=False, na=False).to_numpy(dtype=bool)
+    return mascara
+
+def ordenar_posicoes(df, posicoes, coluna=None, crescente=True):
+    """Reordena as posições (iloc) pelo valor da coluna; vazios sempre no fim. A ordem original desempata."""
+    if not coluna: return posicoes if crescente else posicoes[::-1]
+    valores = df[coluna].iloc[posicoes].reset_index(drop=True)
+    return posicoes[valores.sort_values(ascending=crescente, kind="stable", na_position="last").index.to_numpy()]
+
+def indicadores(cubo):
+    """Total, promotores, CSAT (%) e média de um cubo (já filtrado)."""
+    total = int(cubo['Qtd'].sum())
+    prom = int(cubo['Prom'].sum())
+    if not total: return total, prom, 0.0, 0.0
+    return total, prom, prom / total * 100, cubo['Soma'].sum() / total
+
+def tendencia(cubo, periodo="D"):
+    """Total, promotores e CSAT por dia (D), semana (W, começando na segunda) ou mês (M). Serve para o cubo e o rollup."""
+    dias = pd.Series(np.asarray(cubo['Dia'], dtype='datetime64[ns]'), index=cubo.index)
+    inicio = dias.dt.to_period(periodo).dt.start_time.rename('Dia')
+    trend = cubo[['Qtd', 'Prom']].groupby(inicio).sum().reset_index().rename(columns={'Qtd': 'Total'})
+    trend['Sat'] = (trend['Prom']/trend['Total']*100).round(2)
+    return trend
+
+def ranking_agentes(cubo):
+    rank = cubo.groupby('Agente', observed=True)[['Qtd', 'Prom', 'Soma']].sum().reset_index()
+    rank['Media'] = rank['Soma'] / rank['Qtd']
+    rank['CSAT'] = (rank['Prom']/rank['Qtd']*100).round(2)
+    return rank.sort_values('CSAT', ascending=False)
+
+# --- API ---
+_sessao = None
+_sessao_lock = threading.Lock()
+
+def sessao_http():
+    """
+    Session única do processo (thread-safe para GETs/POSTs simples): as conexões TCP/TLS ficam abertas
+    e são reaproveitadas entre páginas, threads e jobs. Cookies são recusados; a API só usa o token.
+    """
+    global _sessao
+    with _sessao_lock:
+        if _sessao is None:
+            sessao = requests.Session()
+            adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=CONEXOES_POR_HOST)
+            sessao.mount("http://", adaptador)
+            sessao.mount("https://", adaptador)
+            sessao.headers.update(CABECALHOS_HTTP)
+            sessao.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            _sessao = sessao
+    return _sessao
+
+def ler_json(r):
+    """Corpo JSON de uma resposta (já descompactada pelo urllib3), sem passar por texto."""
+    return decodificar_json(r.content)
+
+def autenticar(url, login, senha):
+    if not url or not login: return None
+    try:
+        r = sessao_http().post(f"{url}/rest/v2/authuser", json={"login": login, "chave": senha}, timeout=20)
+        dados = ler_json(r) if r.status_code == 200 else {}
+        if dados.get("success"): return dados["result"]["token"]
+    except: pass
+    return None
+
+# Descoberta (pesquisas/serviços) de uma conta. Falhas levantam exceção. A interface embrulha estas
+# funções num cache do processo (TTL_DESCOBERTA_S); o token vem como _token para ficar fora da chave.
+def pesquisas_da_conta(base_url, _token, id_conta, d_ini, d_fim):
+    pesquisas = {}
+    page = 1
+    while True:
+        params = {"data_inicial": d_ini.strftime("%Y-%m-%d"), "data_final": d_fim.strftime("%Y-%m-%d"), "id_conta": id_conta, "page": page, "limit": LIMITE_DESCOBERTA}
+        r = sessao_http().get(f"{base_url}/rest/v2/relPesquisa", headers={"Authorization": f"Bearer {_token}"}, params=params, timeout=10)
+        r.raise_for_status()
+        rows = ler_json(r).get("rows", [])
+        novas = {str(row.get("cod_pesquisa")): row.get("nom_pesquisa") for row in rows}
+        # Página vazia, incompleta ou repetida (API que ignora "page") encerra a paginação
+        if not novas or novas.keys() <= pesquisas.keys():
+            break
+        pesquisas.update({k: v for k, v in novas.items() if k not in pesquisas})
+        if len(rows) < LIMITE_DESCOBERTA or page >= MAX_PAGINAS: break
+        page += 1
+    return [{"id": k, "nome": v} for k, v in pesquisas.items()]
+
+def servicos_da_conta(base_url, _token, id_conta, d_ini, d_fim, timeout):
+    servicos = set()
+    page = 1
+    while True:
+        params = {
+            "data_inicial": d_ini.strftime("%Y-%m-%d 00:00:00"),
+            "data_final": d_fim.strftime("%Y-%m-%d 23:59:59"),
+            "id_conta": id_conta,
+            "agrupador": "servico",
+            "page": page,
+            "limit": LIMITE_DESCOBERTA_SERVICOS
+        }
+        r = sessao_http().get(f"{base_url}/rest/v2/relAtEstatistico", headers={"Authorization": f"Bearer {_token}"}, params=params, timeout=timeout)
+        r.raise_for_status()
+        data = ler_json(r)
+        rows = data if isinstance(data, list) else data.get("rows", [])
+        nomes = {str(row.get("agrupador")).upper() for row in rows if row.get("agrupador") and row.get("agrupador") != "ATENDIMENTO AUTOMATICO"}
+        tamanho_antes = len(servicos)
+        servicos |= nomes
+        if not rows or len(servicos) == tamanho_antes: break
+        if len(rows) < LIMITE_DESCOBERTA_SERVICOS or page >= MAX_PAGINAS: break
+        page += 1
+    return sorted(servicos)
+
+def _em_paralelo(func, itens):
+    """Roda func(item) para cada item em threads. Retorna {item: resultado}; itens com erro ficam de fora."""
+    resultados = {}
+    if not itens: return resultados
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS_DESCOBERTA, len(itens))) as pool:
+        futuros = {pool.submit(func, item): item for item in itens}
+        for fut in as_completed(futuros):
+            try: resultados[futuros[fut]] = fut.result()
+            except Exception: pass
+    return resultados
+
+def listar_pesquisas(base_url, token, lista_contas, d_ini, d_fim, consulta=pesquisas_da_conta):
+    por_conta = _em_paralelo(lambda id_conta: consulta(base_url, token, id_conta, d_ini, d_fim), list(lista_contas))
+    # Mantém a ordem das contas selecionadas na deduplicação
+    encontradas = [p for id_conta in lista_contas for p in por_conta.get(id_conta, [])]
+    return list({v['id']: v for v in encontradas}.values())
+
+def listar_servicos_api(base_url, token, lista_contas, d_ini, d_fim, consulta=servicos_da_conta):
+    """
+    Serviços de todas as contas selecionadas. Conta sem serviço no período tenta os últimos 30 dias.
+    Retorna (servicos, usou_fallback).
+    """
+    dt_fallback_ini = max(d_fim - timedelta(days=30), d_ini)
+
+    def _servicos(id_conta):
+        try: servicos = consulta(base_url, token, id_conta, d_ini, d_fim, 25)
+        except Exception: servicos = []
+        if servicos: return servicos, False
+        return consulta(base_url, token, id_conta, dt_fallback_ini, d_fim, 15), True
+
+    por_conta = _em_paralelo(_servicos, list(lista_contas))
+    usou_fallback = any(fallback and servicos for servicos, fallback in por_conta.values())
+    return sorted({s for servicos, _ in por_conta.values() for s in servicos}), usou_fallback
+
+class LimitadorTaxa:
+    """Garante um intervalo mínimo entre requisições (compartilhado entre threads)."""
+    def __init__(self, req_por_segundo):
+        self.intervalo = 1.0 / req_por_segundo if req_por_segundo else 0.0
+        self.proxima = 0.0
+        self.lock = threading.Lock()
+
+    def aguardar(self):
+        if not self.intervalo: return
+        with self.lock:
+            agora = time.monotonic()
+            espera = self.proxima - agora
+            self.proxima = max(agora, self.proxima) + self.intervalo
+        if espera > 0: time.sleep(espera)
+
+    def pausar(self, segundos):
+        """Empurra a próxima requisição de todas as threads (ex.: Retry-After de um 429)."""
+        with self.lock:
+            self.proxima = max(self.proxima, time.monotonic() + segundos)
+
+class Telemetria:
+    """
+    Medições de um download/relatório, compartilhadas entre threads: tempo por etapa,
+    histogramas (latência das requisições, páginas por fatia) e contadores (bytes, status, linhas).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.etapas = {}        # etapa -> [execuções, segundos]
+        self.histogramas = {}   # nome -> {"baldes": [contagem por balde + excedente], "soma", "total"}
+        self.contadores = {}    # nome -> {rótulo: valor}
+
+    @contextmanager
+    def etapa(self, nome):
+        inicio = time.perf_counter()
+        try: yield
+        finally: self.registrar_etapa(nome, time.perf_counter() - inicio)
+
+    def registrar_etapa(self, nome, segundos):
+        with self.lock:
+            e = self.etapas.setdefault(nome, [0, 0.0])
+            e[0] += 1
+            e[1] += segundos
+
+    def observar(self, nome, valor):
+        limites = BALDES_TELEMETRIA[nome]
+        with self.lock:
+            h = self.histogramas.setdefault(nome, {"baldes": [0] * (len(limites) + 1), "soma": 0.0, "total": 0})
+            h["baldes"][next((k for k, lim in enumerate(limites) if valor <= lim), len(limites))] += 1
+            h["soma"] += valor
+            h["total"] += 1
+
+    def contar(self, nome, valor=1, rotulo=""):
+        if not valor: return
+        with self.lock:
+            c = self.contadores.setdefault(nome, {})
+            c[rotulo] = c.get(rotulo, 0) + valor
+
+    def copia(self):
+        """Retrato independente das medições, para quem vai seguir medindo por conta própria."""
+        nova = Telemetria()
+        with self.lock:
+            nova.etapas = {k: list(e) for k, e in self.etapas.items()}
+            nova.histogramas = {k: {"baldes": list(h["baldes"]), "soma": h["soma"], "total": h["total"]} for k, h in self.histogramas.items()}
+            nova.contadores = {k: dict(c) for k, c in self.contadores.items()}
+        return nova
+
+    def para_dict(self):
+        with self.lock:
+            return {
+                "etapas": {k: {"execucoes": n, "segundos": round(seg, 4)} for k, (n, seg) in self.etapas.items()},
+                "histogramas": {k: {"limites": list(BALDES_TELEMETRIA[k]), "baldes": list(h["baldes"]),
+                                    "soma": round(h["soma"], 4), "total": h["total"]} for k, h in self.histogramas.items()},
+                "contadores": {k: dict(c) for k, c in self.contadores.items()},
+            }
+
+    def para_json(self):
+        return json.dumps(self.para_dict(), indent=2, ensure_ascii=False)
+
+    def para_prometheus(self, prefixo="satisfador"):
+        """Formato texto de exposição do Prometheus."""
+        dados = self.para_dict()
+        linhas = [f"# TYPE {prefixo}_etapa_segundos_total counter"]
+        linhas += [f'{prefixo}_etapa_segundos_total{{etapa="{k}"}} {e["segundos"]}' for k, e in dados["etapas"].items()]
+        linhas.append(f"# TYPE {prefixo}_etapa_execucoes_total counter")
+        linhas += [f'{prefixo}_etapa_execucoes_total{{etapa="{k}"}} {e["execucoes"]}' for k, e in dados["etapas"].items()]
+        for nome, h in dados["histogramas"].items():
+            linhas.append(f"# TYPE {prefixo}_{nome} histogram")
+            acumulado = 0
+            for limite, qtd in zip(h["limites"] + ["+Inf"], h["baldes"]):
+                acumulado += qtd
+                linhas.append(f'{prefixo}_{nome}_bucket{{le="{limite}"}} {acumulado}')
+            linhas += [f"{prefixo}_{nome}_sum {h['soma']}", f"{prefixo}_{nome}_count {h['total']}"]
+        for nome, c in dados["contadores"].items():
+            linhas.append(f"# TYPE {prefixo}_{nome}_total counter")
+            chave = ROTULOS_TELEMETRIA.get(nome)
+            for rotulo, valor in c.items():
+                rotulos = f'{{{chave}="{rotulo}"}}' if chave and rotulo else ""
+                linhas.append(f"{prefixo}_{nome}_total{rotulos} {valor}")
+        return "\n".join(linhas) + "\n"
+
+_limitadores = {}
+_limitadores_lock = threading.Lock()
+
+def get_limitador(url, req_por_segundo=LIMITE_REQ_POR_SEGUNDO):
+    host = urlparse(url).netloc
+    with _limitadores_lock:
+        lim = _limitadores.get(host)
+        if lim is None or lim.intervalo != (1.0 / req_por_segundo if req_por_segundo else 0.0):
+            lim = _limitadores[host] = LimitadorTaxa(req_por_segundo)
+    return lim
+
+def projetar_resposta(resp):
+    return {k: resp[k] for k in CAMPOS_RESPOSTA if k in resp}
+
+class AutenticadorApi:
+    """Token compartilhado entre threads, renovado via autenticar() quando a API o rejeita."""
+    def __init__(self, base_url, login, senha, token=None):
+        self.base_url = base_url
+        self.login = login
+        self.senha = senha
+        self.token = token
+        self.lock = threading.Lock()
+
+    def cabecalhos(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    def renovar(self, token_rejeitado):
+        """Renova o token (uma vez só, mesmo com várias threads). Retorna True se há um token novo."""
+        with self.lock:
+            if self.token == token_rejeitado:
+                novo = autenticar(self.base_url, self.login, self.senha)
+                if novo: self.token = novo
+            return self.token != token_rejeitado
+
+def _retry_after(r):
+    valor = r.headers.get("Retry-After")
+    if not valor: return None
+    try: return max(0.0, float(valor))
+    except ValueError: pass
+    try: return max(0.0, (parsedate_to_datetime(valor) - datetime.now(parsedate_to_datetime(valor).tzinfo)).total_seconds())
+    except (TypeError, ValueError): return None
+
+def requisitar(url, params, autenticador, timeout=45, limitador=None, tentativas=MAX_TENTATIVAS, telemetria=None):
+    """
+    GET com backoff exponencial + jitter. Respeita Retry-After (429/503) e renova o token em 401/403.
+    Retorna a resposta 200 ou levanta requests.RequestException depois de esgotar as tentativas.
+    """
+    reautenticou = False
+    for tentativa in range(tentativas):
+        if limitador: limitador.aguardar()
+        token = autenticador.token
+        inicio = time.perf_counter()
+        try:
+            r = sessao_http().get(url, headers=autenticador.cabecalhos(), params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            r = None
+        if telemetria:
+            telemetria.observar("requisicao_segundos", time.perf_counter() - inicio)
+            telemetria.contar("requisicoes", rotulo=str(r.status_code) if r is not None else "erro_rede")
+            if tentativa: telemetria.contar("retentativas")
+
+        if r is not None:
+            if r.status_code == 200:
+                # Bytes que passaram pela rede (compactados, quando o servidor manda gzip)
+                if telemetria: telemetria.contar("bytes_recebidos", int(r.headers.get("Content-Length") or len(r.content)))
+                return r
+            if r.status_code in (401, 403):
+                # Uma renovação por requisição: se o token novo também é recusado (ou não veio), falha já
+                if not reautenticou:
+                    reautenticou = True
+                    if autenticador.renovar(token): continue
+                r.raise_for_status()
+            if r.status_code not in (408, 429) and r.status_code < 500:
+                r.raise_for_status()
+
+        espera = _retry_after(r) if r is not None and r.status_code in (429, 503) else None
+        if espera is not None:
+            if limitador: limitador.pausar(espera)
+        else:
+            espera = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** tentativa))
+        if tentativa < tentativas - 1: time.sleep(espera)
+
+    if r is not None: r.raise_for_status()
+    raise requests.ConnectionError(f"Falha após {tentativas} tentativas: {url}")
+
+def _paginar(url, autenticador, id_conta, id_pesquisa, dt_start, dt_end, limit_size, limitador, max_paginas, telemetria=None,
+             pagina_inicial=1):
+    """Pagina uma janela (a partir de pagina_inicial) até o fim dos dados. Retorna (registros, completo, estourou, requisicoes, itens)."""
+    registros = []
+    completo = False
+    estourou = False
+    requisicoes = 0
+    itens = 0
+    page = pagina_inicial
+
+    while True:
+        try:
+            params = {
+                "data_inicial": dt_start.strftime("%Y-%m-%d"),
+                "data_final": dt_end.strftime("%Y-%m-%d"),
+                "pesquisa": id_pesquisa,
+                "id_conta": id_conta,
+                "page": page,
+                "limit": limit_size
+            }
+
+            requisicoes += 1
+            r = requisitar(url, params, autenticador, timeout=45, limitador=limitador, telemetria=telemetria)
+
+            inicio = time.perf_counter()
+            data = ler_json(r)
+            if telemetria: telemetria.registrar_etapa("json", time.perf_counter() - inicio)
+            if not data:
+                completo = True
+                break
+
+            itens_pagina = 0
+            for bloco in data:
+                respostas = bloco.get("respostas", [])
+                itens_pagina += len(respostas)
+
+                cod_pergunta = str(bloco.get("cod_pergunta", ""))
+                nom_pergunta = str(bloco.get("nom_pergunta", "")).lower()
+                nome_servico = bloco.get("nom_servico") or bloco.get("servico") or "N/A"
+
+                if (str(id_pesquisa) == ID_PESQUISA_V3 and cod_pergunta == ID_PERGUNTA_IGNORAR_V3) or \
+                        "internet" in nom_pergunta or ("serviço" in nom_pergunta and "atendimento" not in nom_pergunta):
+                    if telemetria: telemetria.contar("linhas", len(respostas), "filtradas")
+                    continue
+
+                for resp in respostas:
+                    registros.append((cod_pergunta, bloco.get("nom_pergunta", ""), nome_servico, projetar_resposta(resp)))
+            itens += itens_pagina
+
+            # Fim exato: a página veio incompleta (conte o limite em blocos ou em respostas)
+            if max(len(data), itens_pagina) < limit_size:
+                completo = True
+                break
+            page += 1
+            if max_paginas and page > max_paginas:
+                estourou = True
+                break
+
+        except Exception:
+            # Tentativas esgotadas: a fatia fica incompleta (sem cache) e é refeita na próxima vez
+            break
+
+    return registros, completo, estourou, requisicoes, itens
+
+def baixar_fatia(url, autenticador, id_conta, id_pesquisa, dt_start, dt_end, limit_size, limitador=None, telemetria=None,
+                 sondar=False):
+    """
+    Baixa todas as páginas de uma fatia (intervalo x conta x pesquisa).
+    Roda em thread de trabalho: não pode chamar nada do Streamlit.
+    Se a janela passar de MAX_PAGINAS ela é dividida ao meio (até chegar a um dia, que é paginado sem teto).
+    Com sondar (volume da conta ainda desconhecido), a página MAX_PAGINAS é pedida primeiro: cheia, a
+    janela é dividida sem baixar as anteriores; incompleta, ela é a última página e é aproveitada.
+    Retorna (registros, completo, requisicoes, itens): lista de (cod_pergunta, nom_pergunta, servico, resposta)
+    já filtrada e projetada em CAMPOS_RESPOSTA, se a fatia foi baixada até o fim sem erros,
+    quantas requisições foram feitas e quantas respostas a API devolveu.
+    """
+    max_paginas = MAX_PAGINAS if dt_end > dt_start else None
+    if sondar and max_paginas:
+        r_fim, c_fim, estourou, requisicoes, i_fim = _paginar(
+            url, autenticador, id_conta, id_pesquisa, dt_start, dt_end, limit_size, limitador, max_paginas, telemetria, max_paginas)
+        if c_fim:
+            # Cabe na janela: faltam só as páginas antes da sondada (se todas vierem cheias, a sondada é a seguinte)
+            registros, completo, cheias, q, itens = _paginar(
+                url, autenticador, id_conta, id_pesquisa, dt_start, dt_end, limit_size, limitador, max_paginas - 1, telemetria)
+            return registros + r_fim, completo or cheias, requisicoes + q, itens + i_fim
+    else:
+        registros, completo, estourou, requisicoes, itens = _paginar(
+            url, autenticador, id_conta, id_pesquisa, dt_start, dt_end, limit_size, limitador, max_paginas, telemetria)
+        if not estourou:
+            return registros, completo, requisicoes, itens
+    if not estourou:
+        return [], False, requisicoes, 0     # a sondagem falhou (tentativas esgotadas)
+
+    # Estourou o teto: as metades são sondadas antes, para não baixar de novo páginas que seriam descartadas
+    meio = dt_start + timedelta(days=(dt_end - dt_start).days // 2)
+    r1, c1, q1, i1 = baixar_fatia(url, autenticador, id_conta, id_pesquisa, dt_start, meio, limit_size, limitador, telemetria, True)
+    r2, c2, q2, i2 = baixar_fatia(url, autenticador, id_conta, id_pesquisa, meio + timedelta(days=1), dt_end, limit_size, limitador, telemetria, True)
+    return r1 + r2, c1 and c2, requisicoes + q1 + q2, i1 + i2
+
+_densidades = {}    # (url, conta, pesquisa) -> respostas por dia observadas neste processo
+
+def dias_janela(densidade, limit_size):
+    """Tamanho da janela (em dias além do inicial) para que cada janela ocupe ~OCUPACAO_ALVO do teto de páginas."""
+    if not densidade: return DIAS_JANELA_PADRAO
+    dias = int(limit_size * MAX_PAGINAS * OCUPACAO_ALVO / densidade)
+    return max(0, min(DIAS_JANELA_MAX, dias))
+
+def requisicoes_janela_fixa(contagem_dias, d_ini, d_fim, limit_size, dias=DIAS_JANELA_PADRAO):
+    """Estimativa de requisições do esquema antigo (janelas fixas) para a mesma contagem de respostas por dia."""
+    total = 0
+    inicio = d_ini
+    while inicio <= d_fim:
+        fim = min(inicio + timedelta(days=dias), d_fim)
+        n = sum(contagem_dias.get(inicio + timedelta(days=k), 0) for k in range((fim - inicio).days + 1))
+        total += n // limit_size + 1
+        inicio = fim + timedelta(days=1)
+    return total
+
+def abrir_cache(caminho=CACHE_DB_PATH):
+    conn = sqlite3.connect(caminho)
+    conn.execute("""CREATE TABLE IF NOT EXISTS respostas (
+        id_conta TEXT, pesquisa TEXT, dia TEXT,
+        cod_pergunta TEXT, nom_pergunta TEXT, nom_servico TEXT, resp TEXT)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_respostas ON respostas (id_conta, pesquisa, dia)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS dias_baixados (
+        id_conta TEXT, pesquisa TEXT, dia TEXT, baixado_em TEXT,
+        PRIMARY KEY (id_conta, pesquisa, dia))""")
+    # Checkpoints: fatias já concluídas de um download (job) que ainda não terminou
+    conn.execute("""CREATE TABLE IF NOT EXISTS checkpoint_fatias (
+        job TEXT, id_conta TEXT, pesquisa TEXT, dt_ini TEXT, dt_fim TEXT, criado_em TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS checkpoint_respostas (
+        job TEXT, id_conta TEXT, pesquisa TEXT, dt_ini TEXT,
+        cod_pergunta TEXT, nom_pergunta TEXT, nom_servico TEXT, resp TEXT)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_checkpoint ON checkpoint_respostas (job, id_conta, pesquisa, dt_ini)")
+    # Rollup diário (dia x conta x pesquisa x agente x serviço) das respostas baixadas da API: base da
+    # tendência de longo prazo. Por pesquisa, para que cada download substitua só o que baixou.
+    conn.execute("""CREATE TABLE IF NOT EXISTS rollup_diario (
+        dia TEXT, id_conta TEXT, pesquisa TEXT, agente TEXT, servico TEXT, qtd INTEGER, prom INTEGER, soma INTEGER,
+        PRIMARY KEY (dia, id_conta, pesquisa, agente, servico)) WITHOUT ROWID""")
+    return conn
+
+def dia_fechado(dia):
+    return dia <= date.today() - timedelta(days=DIAS_CACHE_ABERTOS)
+
+def dias_em_cache(conn, id_conta, id_pesquisa, d_ini, d_fim):
+    cur = conn.execute(
+        "SELECT dia FROM dias_baixados WHERE id_conta = ? AND pesquisa = ? AND dia BETWEEN ? AND ?",
+        (str(id_conta), str(id_pesquisa), d_ini.isoformat(), d_fim.isoformat()))
+    return {date.fromisoformat(row[0]) for row in cur if dia_fechado(date.fromisoformat(row[0]))}
+
+def ler_cache(conn, id_conta, id_pesquisa, d_ini, d_fim):
+    cur = conn.execute(
+        "SELECT cod_pergunta, nom_pergunta, nom_servico, resp FROM respostas "
+        "WHERE id_conta = ? AND pesquisa = ? AND dia BETWEEN ? AND ? ORDER BY rowid",
+        (str(id_conta), str(id_pesquisa), d_ini.isoformat(), d_fim.isoformat()))
+    return [(cod, nom, serv, projetar_resposta(json.loads(resp))) for cod, nom, serv, resp in cur]
+
+def gravar_cache(conn, id_conta, id_pesquisa, dt_start, dt_end, registros):
+    """Grava apenas os dias fechados do intervalo. Cada resposta fica no seu dia (ou no início do intervalo)."""
+    conta, pesq = str(id_conta), str(id_pesquisa)
+    linhas = []
+    for cod_pergunta, nom_pergunta, nome_servico, resp in registros:
+        try: dia = date.fromisoformat(str(resp.get("dat_resposta", ""))[:10])
+        except ValueError: dia = dt_start
+        if not (dt_start <= dia <= dt_end): dia = dt_start
+        if dia_fechado(dia):
+            linhas.append((conta, pesq, dia.isoformat(), cod_pergunta, nom_pergunta, nome_servico, json.dumps(resp)))
+
+    dias = []
+    dia = dt_start
+    while dia <= dt_end:
+        if dia_fechado(dia): dias.append((conta, pesq, dia.isoformat(), datetime.now().isoformat(timespec="seconds")))
+        dia += timedelta(days=1)
+    if not dias: return
+
+    with conn:
+        conn.execute("DELETE FROM respostas WHERE id_conta = ? AND pesquisa = ? AND dia BETWEEN ? AND ?",
+                     (conta, pesq, dt_start.isoformat(), dt_end.isoformat()))
+        conn.executemany("INSERT INTO respostas VALUES (?, ?, ?, ?, ?, ?, ?)", linhas)
+        conn.executemany("INSERT OR REPLACE INTO dias_baixados VALUES (?, ?, ?, ?)", dias)
+
+def chave_job(url, lista_contas, lista_pesquisas, d_ini, d_fim):
+    partes = (url, sorted(map(str, lista_contas)), sorted(map(str, lista_pesquisas)), d_ini.isoformat(), d_fim.isoformat())
+    return hashlib.sha1(repr(partes).encode()).hexdigest()[:16]
+
+def fatias_checkpoint(conn, job):
+    """Fatias já concluídas do job (descarta checkpoints vencidos de qualquer job)."""
+    limite = (datetime.now() - timedelta(hours=CHECKPOINT_VALIDADE_H)).isoformat(timespec="seconds")
+    with conn:
+        vencidos = [r[0] for r in conn.execute("SELECT DISTINCT job FROM checkpoint_fatias WHERE criado_em < ?", (limite,))]
+        for j in vencidos: limpar_checkpoint(conn, j)
+    cur = conn.execute("SELECT id_conta, pesquisa, dt_ini, dt_fim FROM checkpoint_fatias WHERE job = ?", (job,))
+    return [(c, p, date.fromisoformat(a), date.fromisoformat(b)) for c, p, a, b in cur]
+
+def ler_checkpoint(conn, job, id_conta, id_pesquisa, dt_start):
+    cur = conn.execute(
+        "SELECT cod_pergunta, nom_pergunta, nom_servico, resp FROM checkpoint_respostas "
+        "WHERE job = ? AND id_conta = ? AND pesquisa = ? AND dt_ini = ? ORDER BY rowid",
+        (job, str(id_conta), str(id_pesquisa), dt_start.isoformat()))
+    return [(cod, nom, serv, json.loads(resp)) for cod, nom, serv, resp in cur]
+
+def gravar_checkpoint(conn, job, id_conta, id_pesquisa, dt_start, dt_end, registros):
+    conta, pesq, ini = str(id_conta), str(id_pesquisa), dt_start.isoformat()
+    with conn:
+        conn.executemany("INSERT INTO checkpoint_respostas VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(job, conta, pesq, ini, cod, nom, serv, json.dumps(resp)) for cod, nom, serv, resp in registros])
+        conn.execute("INSERT INTO checkpoint_fatias VALUES (?, ?, ?, ?, ?, ?)",
+                     (job, conta, pesq, ini, dt_end.isoformat(), datetime.now().isoformat(timespec="seconds")))
+
+def limpar_checkpoint(conn, job):
+    with conn:
+        conn.execute("DELETE FROM checkpoint_respostas WHERE job = ?", (job,))
+        conn.execute("DELETE FROM checkpoint_fatias WHERE job = ?", (job,))
+
+def densidade_cache(conn, id_conta, id_pesquisa):
+    """Respostas por dia já vistas no cache para a conta/pesquisa (None se não houver histórico)."""
+    conta, pesq = str(id_conta), str(id_pesquisa)
+    dias = conn.execute("SELECT COUNT(*) FROM dias_baixados WHERE id_conta = ? AND pesquisa = ?", (conta, pesq)).fetchone()[0]
+    if not dias: return None
+    total = conn.execute("SELECT COUNT(*) FROM respostas WHERE id_conta = ? AND pesquisa = ?", (conta, pesq)).fetchone()[0]
+    return total / dias
+
+def agrupar_dias(dias, max_dias=DIAS_JANELA_PADRAO):
+    """Agrupa dias ordenados em intervalos contíguos de no máximo max_dias+1 dias."""
+    intervalos = []
+    for dia in sorted(dias):
+        if intervalos and dia == intervalos[-1][1] + timedelta(days=1) and (dia - intervalos[-1][0]).days <= max_dias:
+            intervalos[-1] = (intervalos[-1][0], dia)
+        else:
+            intervalos.append((dia, dia))
+    return intervalos
+
+def gravar_rollup(conn, relatorio, lista_contas, lista_pesquisas, d_ini, d_fim):
+    """
+    Atualiza o rollup com as respostas da API de um download completo: cada dia x conta x pesquisa do
+    período pedido é substituído inteiro (baixar de novo não soma em dobro) e o resto fica como está.
+    Linhas de upload (sem pesquisa) não entram: um arquivo pode cobrir só parte de um dia.
+    """
+    base = montar_cubo(relatorio[relatorio['Pesquisa'].notna()], ['Dia', 'conta_origem_id', 'Pesquisa', 'Agente', 'Serviço'])
+    dias = pd.DatetimeIndex(np.asarray(base['Dia'], dtype='datetime64[ns]')).strftime('%Y-%m-%d')
+    chaves = list(zip(dias, base['conta_origem_id'].astype(str), base['Pesquisa'].astype(str)))
+    linhas = [(*k, agente, servico, int(q), int(p), int(s)) for k, agente, servico, q, p, s in zip(
+        chaves, base['Agente'].astype(str), base['Serviço'].astype(str), base['Qtd'], base['Prom'], base['Soma'])]
+    with conn:
+        conn.executemany("DELETE FROM rollup_diario WHERE dia BETWEEN ? AND ? AND id_conta = ? AND pesquisa = ?",
+                         [(d_ini.isoformat(), d_fim.isoformat(), str(c), str(p)) for c in lista_contas for p in lista_pesquisas])
+        conn.executemany("DELETE FROM rollup_diario WHERE dia = ? AND id_conta = ? AND pesquisa = ?", set(chaves))
+        conn.executemany("INSERT INTO rollup_diario VALUES (?, ?, ?, ?, ?, ?, ?, ?)", linhas)
+
+def ler_rollup(conn, lista_contas, d_ini, d_fim):
+    """
+    Rollup do período somado entre as contas e pesquisas (Dia, Agente, Setor, Serviço, Qtd, Prom, Soma), sem tocar nas
+    respostas. A soma sai do SQLite e o DataFrame é montado por coluna: um ano de histórico cabe em décimos de segundo.
+    """
+    contas = [str(c) for c in lista_contas]
+    cur = conn.execute(
+        f"SELECT dia, agente, servico, SUM(qtd), SUM(prom), SUM(soma) FROM rollup_diario "
+        f"WHERE dia BETWEEN ? AND ? AND id_conta IN ({', '.join('?' * len(contas))}) GROUP BY dia, agente, servico",
+        (d_ini.isoformat(), d_fim.isoformat(), *contas))
+    colunas = list(zip(*cur.fetchall())) or [()] * 6
+    rollup = pd.DataFrame({
+        'Dia': pd.to_datetime(pd.Series(colunas[0], dtype=object), format='%Y-%m-%d'),
+        'Agente': pd.Series(colunas[1], dtype=object).astype('category'),
+        'Serviço': pd.Series(colunas[2], dtype=object).astype('category'),
+        **{c: np.array(v, dtype='int64') for c, v in zip(('Qtd', 'Prom', 'Soma'), colunas[3:])},
+    })
+    rollup.insert(2, 'Setor', mapear_unicos(rollup['Agente'], get_setor))
+    return rollup
+
+def _nota_chave(valor):
+    try: return str(int(float(valor)))
+    except (TypeError, ValueError): return ""
+
+def _hash_unicos(serie, func):
+    """Hash (uint64) de func(valor) por linha, calculado uma vez por valor distinto."""
+    codes, uniques = pd.factorize(serie, use_na_sentinel=False)
+    return pd.util.hash_array(np.array([func(u) for u in uniques], dtype=object))[codes]
+
+def _combinar(chave, h):
+    return (chave * np.uint64(1_000_003)) ^ h
+
+def chaves_dedup(df):
+    """
+    Chaves inteiras (uint64, estáveis entre processos) de cada resposta bruta. Retorna (chaves, bases):
+    com protocolo, a base é protocolo + agente (normalizado) e a chave soma a ela o cod_pergunta, como a
+    chave protocolo_agente_pergunta de sempre; sem protocolo, a base cai para conta + agente + data/hora
+    (no segundo) + nota. Sem pergunta (uploads), a chave é a própria base.
+    """
+    protocolo = df['num_protocolo'].astype('string').str.strip().str.replace(r'\.0$', '', regex=True)
+    protocolo = protocolo.mask(protocolo.isin(["0", "nan", "None"]), "").fillna("")
+    bases = _combinar(pd.util.hash_array(protocolo.to_numpy(dtype=object)), _hash_unicos(df['nom_agente'], normalizar_nome))
+    sem_protocolo = (protocolo == "").to_numpy(dtype=bool)
+    if sem_protocolo.any():
+        resto = df.loc[sem_protocolo]
+        datas = pd.to_datetime(resto['dat_resposta'], errors='coerce').dt.floor('s')
+        partes = (
+            _hash_unicos(resto['conta_origem_id'], lambda c: "" if pd.isna(c) else str(c)),
+            pd.util.hash_array(datas.fillna(pd.Timestamp(0)).astype('datetime64[s]').to_numpy().view('int64')),
+            _hash_unicos(resto['nom_valor'], _nota_chave),
+        )
+        extra = bases[sem_protocolo]
+        for h in partes: extra = _combinar(extra, h)
+        bases[sem_protocolo] = extra
+    if 'cod_pergunta' not in df.columns: return bases.copy(), bases
+    pergunta = df['cod_pergunta'].astype('string').fillna("")
+    chaves = _combinar(bases, _hash_unicos(pergunta, str))
+    return np.where((pergunta != "").to_numpy(dtype=bool), chaves, bases), bases
+
+def _ocorrencias(bases, inicio):
+    """Chave da n-ésima ocorrência de cada base (inicio + posição entre as repetições dela no lote)."""
+    ordem = inicio + pd.Series(bases).groupby(bases).cumcount().to_numpy(dtype=np.uint64)
+    return _combinar(bases, pd.util.hash_array(ordem))
+
+class ConjuntoChaves:
+    """
+    Conjunto compacto de chaves uint64 (8 bytes cada) em blocos ordenados, como numa LSM:
+    cada lote novo vira um bloco e blocos de tamanho parecido são intercalados, então adicionar custa
+    só o lote (amortizado) e consultar é uma busca binária por bloco. Os blocos nunca são alterados
+    depois de criados: copia() é barata e as cópias podem ser estendidas sem afetar o original.
+    """
+    def __init__(self):
+        self.blocos = []
+
+    def __len__(self):
+        return sum(len(b) for b in self.blocos)
+
+    def copia(self):
+        conjunto = ConjuntoChaves()
+        conjunto.blocos = list(self.blocos)
+        return conjunto
+
+    def contem(self, chaves):
+        achou = np.zeros(len(chaves), dtype=bool)
+        for bloco in self.blocos:
+            pos = np.minimum(np.searchsorted(bloco, chaves), len(bloco) - 1)
+            achou |= bloco[pos] == chaves
+        return achou
+
+    def adicionar(self, chaves):
+        """Inclui chaves distintas que ainda não estão no conjunto."""
+        ordenadas = np.sort(np.asarray(chaves, dtype=np.uint64))
+        if not len(ordenadas): return
+        self.blocos.append(ordenadas)
+        while len(self.blocos) > 1 and len(self.blocos[-2]) <= 2 * len(self.blocos[-1]):
+            novo = self.blocos.pop()
+            self.blocos[-1] = np.sort(np.concatenate((self.blocos[-1], novo)), kind="stable")  # blocos disjuntos: intercalação
+
+    def contar(self, bases):
+        """Quantas ocorrências (_ocorrencias) de cada base já estão no conjunto; uma rodada por repetição."""
+        unicas, inverso = np.unique(bases, return_inverse=True)
+        total = np.zeros(len(unicas), dtype=np.uint64)
+        pendentes = np.arange(len(unicas))
+        while len(pendentes):
+            achou = self.contem(_combinar(unicas[pendentes], pd.util.hash_array(total[pendentes])))
+            pendentes = pendentes[achou]
+            total[pendentes] += np.uint64(1)
+        return total[inverso]
+
+class IndiceDedup:
+    """
+    Respostas já vistas, como multiconjunto por base (chaves_dedup). Respostas com pergunta (API) se
+    reconhecem pela chave completa. Cada resposta guardada ocupa uma ocorrência da sua base: a n-ésima
+    resposta sem pergunta (upload) de um lote é repetida se a base já tem n ocorrências; a n-ésima
+    resposta nova da API com aquela base é a mesma de um upload se ele já ocupou essa ocorrência.
+    """
+    def __init__(self, chaves=(), bases=()):
+        self.completas = ConjuntoChaves()     # chaves com pergunta já vistas
+        self.ocorrencias = ConjuntoChaves()   # ocorrências de cada base, de qualquer origem
+        self.da_api = ConjuntoChaves()        # ocorrências de cada base já atribuídas a respostas com pergunta
+        if len(chaves): self.registrar(chaves, bases)
+
+    def __len__(self):
+        return len(self.ocorrencias)
+
+    def copia(self):
+        indice = IndiceDedup()
+        indice.completas, indice.ocorrencias, indice.da_api = self.completas.copia(), self.ocorrencias.copia(), self.da_api.copia()
+        return indice
+
+    def registrar(self, chaves, bases):
+        """
+        Máscara das respostas novas e registra essas. Com pergunta, a repetição dentro do lote é descartada
+        (vale a primeira); sem pergunta, cada repetição é mais uma ocorrência da base.
+        """
+        chaves = np.asarray(chaves, dtype=np.uint64)
+        bases = np.asarray(bases, dtype=np.uint64)
+        mascara = np.zeros(len(chaves), dtype=bool)
+        com_pergunta = np.flatnonzero(chaves != bases)
+        if len(com_pergunta):
+            unicas, primeiras = np.unique(chaves[com_pergunta], return_index=True)
+            novas = ~self.completas.contem(unicas)
+            self.completas.adicionar(unicas[novas])
+            pos = com_pergunta[np.sort(primeiras[novas])]
+            slots = _ocorrencias(bases[pos], self.da_api.contar(bases[pos]))
+            self.da_api.adicionar(slots)
+            livres = ~self.ocorrencias.contem(slots)
+            self.ocorrencias.adicionar(slots[livres])
+            mascara[pos[livres]] = True
+        sem_pergunta = np.flatnonzero(chaves == bases)
+        if len(sem_pergunta):
+            slots = _ocorrencias(bases[sem_pergunta], 0)
+            livres = ~self.ocorrencias.contem(slots)
+            self.ocorrencias.adicionar(slots[livres])
+            mascara[sem_pergunta[livres]] = True
+        return mascara
+
+def mesclar_relatorios(df, cubo, indice, df_novo):
+    """
+    Soma um relatório processado (com Chave) ao que já está carregado sem contar nada duas vezes:
+    só as linhas fora do índice entram, e o cubo recebe apenas o agregado delas.
+    Não altera os argumentos. Retorna (df, cubo, indice, linhas_novas).
+    """
+    indice = indice.copia()
+    novas = df_novo[indice.registrar(df_novo['Chave'].to_numpy(), df_novo['Chave_Base'].to_numpy())]
+    if novas.empty: return df, cubo, indice, 0
+    df = pd.concat([df, novas], ignore_index=True).astype(TIPOS_RELATORIO)
+    cubo = pd.concat([cubo, montar_cubo(novas)], ignore_index=True)
+    cubo = cubo.astype({c: "category" for c in DIMENSOES_CUBO})
+    cubo = cubo.groupby(DIMENSOES_CUBO, observed=True, dropna=False)[["Qtd", "Prom", "Soma"]].sum().reset_index()
+    return df, cubo, indice, len(novas)
+
+def deduplicar(df, indice):
+    """Linhas do DataFrame bruto fora do índice (na ordem), com as colunas "chave" e "chave_base"; elas entram no índice."""
+    chaves, bases = chaves_dedup(df)
+    mascara = indice.registrar(chaves, bases)
+    return df[mascara].assign(chave=chaves[mascara], chave_base=bases[mascara]).reset_index(drop=True)
+
+class BufferRespostas:
+    """Acumula as respostas direto em colunas (COLUNAS_BRUTAS + cod_pergunta, que entra só na chave de dedup)."""
+    def __init__(self):
+        self.colunas = {c: [] for c in COLUNAS_BUFFER}
+
+    def __len__(self):
+        return len(self.colunas["nom_valor"])
+
+    def mesclar_fatia(self, registros, id_conta, id_pesquisa=""):
+        conta = str(id_conta)
+        pesquisa = str(id_pesquisa)
+        cols = self.colunas
+        for cod_pergunta, _, nome_servico, resp in registros:
+            servico_final = nome_servico
+            if servico_final == "N/A":
+                servico_final = resp.get("nom_servico") or resp.get("servico") or "N/A"
+
+            cols["nom_valor"].append(resp.get("nom_valor"))
+            cols["dat_resposta"].append(resp.get("dat_resposta"))
+            cols["nom_agente"].append(resp.get("nom_agente"))
+            cols["num_protocolo"].append(resp.get("num_protocolo"))
+            cols["nom_resposta"].append(resp.get("nom_resposta"))
+            cols["conta_origem_id"].append(conta)
+            cols["nom_servico"].append(str(servico_final).upper())
+            cols["cod_pergunta"].append(cod_pergunta)
+            cols["id_pesquisa"].append(pesquisa)
+        return len(registros)
+
+    def para_dataframe(self):
+        df = pd.DataFrame(self.colunas, columns=COLUNAS_BUFFER)
+        self.colunas = {c: [] for c in COLUNAS_BUFFER}
+        return df
+
+def baixar_dados_fracionado(base_url, token, lista_contas, lista_pesquisas, d_ini, d_fim, limit_size,
+                            max_workers=MAX_WORKERS_PADRAO, req_por_segundo=LIMITE_REQ_POR_SEGUNDO, usar_cache=True,
+                            autenticador=None, progresso=None, pool=None, cancelar=None, telemetria=None, indice=None):
+    """
+    Baixa o RelPesqAnalitico sem tocar na interface: o andamento sai por progresso(fracao, mensagem).
+    As respostas são deduplicadas por indice (IndiceDedup), que também recebe as chaves novas; a
+    coluna "chave" do DataFrame leva a chave de cada linha.
+    Com pool, as fatias vão para esse executor compartilhado (no máximo max_workers por vez);
+    sem pool, cria um só para esta chamada. cancelar (função sem argumentos) interrompe entre fatias quando devolve True.
+    As medições vão para telemetria, se vier uma; o resumo delas fica também em df.attrs["telemetria"].
+    """
+    inicio_download = time.perf_counter()
+    if telemetria is None: telemetria = Telemetria()
+    url = f"{base_url}/rest/v2/RelPesqAnalitico"
+    if autenticador is None: autenticador = AutenticadorApi(base_url, None, None, token)
+    buffer = BufferRespostas()
+    if indice is None: indice = IndiceDedup()
+    limitador = get_limitador(url, req_por_segundo)
+    conn = abrir_cache()
+    job = chave_job(url, lista_contas, lista_pesquisas, d_ini, d_fim)
+    checkpoints = fatias_checkpoint(conn, job)
+
+    # Fatias: (inicio, fim, conta, pesquisa, origem). Origem "checkpoint" = concluída num download
+    # interrompido deste mesmo job; "cache" = dias fechados já gravados; "api" = o restante, em janelas
+    # do tamanho do volume da conta.
+    fatias = []
+    sem_densidade = set()   # (conta, pesquisa) sem volume conhecido: as janelas delas são sondadas
+    for id_conta in lista_contas:
+        for id_pesquisa in lista_pesquisas:
+            todos = {d_ini + timedelta(days=i) for i in range((d_fim - d_ini).days + 1)}
+            dias_ck = set()
+            for c, p, dt_start, dt_end in checkpoints:
+                if c == str(id_conta) and p == str(id_pesquisa):
+                    fatias.append((dt_start, dt_end, id_conta, id_pesquisa, "checkpoint"))
+                    dias_ck |= {dt_start + timedelta(days=k) for k in range((dt_end - dt_start).days + 1)}
+            em_cache = (dias_em_cache(conn, id_conta, id_pesquisa, d_ini, d_fim) - dias_ck) if usar_cache else set()
+            densidade = _densidades.get((url, str(id_conta), str(id_pesquisa)))
+            if densidade is None and usar_cache: densidade = densidade_cache(conn, id_conta, id_pesquisa)
+            if not densidade: sem_densidade.add((id_conta, id_pesquisa))
+            for dt_start, dt_end in agrupar_dias(em_cache, DIAS_JANELA_MAX):
+                fatias.append((dt_start, dt_end, id_conta, id_pesquisa, "cache"))
+            for dt_start, dt_end in agrupar_dias(todos - em_cache - dias_ck, dias_janela(densidade, limit_size)):
+                fatias.append((dt_start, dt_end, id_conta, id_pesquisa, "api"))
+    ordem_contas = {c: i for i, c in enumerate(lista_contas)}
+    ordem_pesquisas = {p: i for i, p in enumerate(lista_pesquisas)}
+    fatias.sort(key=lambda f: (f[0], ordem_contas[f[2]], ordem_pesquisas[f[3]]))
+
+    total_steps = len(fatias)
+    current_step = 0
+    total_baixados = 0
+
+    # As fatias rodam em paralelo, mas a mesclagem segue a ordem original
+    # para manter a deduplicação idêntica ao download sequencial.
+    concluidas = {}
+    proxima_mescla = 0
+    total_cache = 0
+    total_checkpoint = 0
+    incompletas = 0
+    requisicoes = 0
+    contagem_dias = {}      # (conta, pesquisa) -> {dia: respostas}, para estimar o custo das janelas fixas
+
+    def _contar(id_conta, id_pesquisa, dt_start, registros):
+        dias = contagem_dias.setdefault((id_conta, id_pesquisa), {})
+        for _, _, _, resp in registros:
+            try: dia = date.fromisoformat(str(resp.get("dat_resposta", ""))[:10])
+            except ValueError: dia = dt_start
+            dias[dia] = dias.get(dia, 0) + 1
+
+    def _avancar(i):
+        nonlocal proxima_mescla, total_baixados, current_step
+        while proxima_mescla in concluidas:
+            _, _, id_conta, id_pesquisa, _ = fatias[proxima_mescla]
+            registros = concluidas.pop(proxima_mescla)
+            total_baixados += buffer.mesclar_fatia(registros, id_conta, id_pesquisa)
+            proxima_mescla += 1
+
+        current_step += 1
+        dt_start, dt_end, id_conta, id_pesquisa, _ = fatias[i]
+        if progresso: progresso(min(current_step / max(total_steps, 1), 1.0), f"⏳ Baixado **{dt_start.strftime('%d/%m')} a {dt_end.strftime('%d/%m')}** | Conta {id_conta} | Pesquisa {id_pesquisa} | Fatias: **{current_step}/{total_steps}** | Do cache: **{total_cache}** | Retomadas: **{total_checkpoint}** | Encontrados: **{total_baixados}**")
+
+    for i, (dt_start, dt_end, id_conta, id_pesquisa, origem) in enumerate(fatias):
+        if origem == "checkpoint":
+            with telemetria.etapa("cache_local"): concluidas[i] = ler_checkpoint(conn, job, id_conta, id_pesquisa, dt_start)
+            total_checkpoint += 1
+        elif origem == "cache":
+            with telemetria.etapa("cache_local"): concluidas[i] = ler_cache(conn, id_conta, id_pesquisa, dt_start, dt_end)
+            total_cache += 1
+        else: continue
+        _contar(id_conta, id_pesquisa, dt_start, concluidas[i])
+        _avancar(i)
+
+    # Submete aos poucos (no máximo max_workers em andamento) para dividir um pool compartilhado
+    # de forma justa entre downloads simultâneos.
+    fila = deque(i for i, f in enumerate(fatias) if f[4] == "api")
+    limite = max(1, int(max_workers))
+    proprio_pool = pool is None
+    if proprio_pool: pool = ThreadPoolExecutor(max_workers=limite)
+    em_andamento = {}
+    try:
+        while fila or em_andamento:
+            if cancelar is not None and cancelar(): break
+            while fila and len(em_andamento) < limite:
+                i = fila.popleft()
+                dt_start, dt_end, id_conta, id_pesquisa, _ = fatias[i]
+                em_andamento[pool.submit(baixar_fatia, url, autenticador, id_conta, id_pesquisa, dt_start, dt_end, limit_size, limitador,
+                                         telemetria, (id_conta, id_pesquisa) in sem_densidade)] = i
+
+            feitos, _ = wait(em_andamento, timeout=0.5, return_when=FIRST_COMPLETED)
+            for fut in feitos:
+                i = em_andamento.pop(fut)
+                try: registros, completo, n_req, itens = fut.result()
+                except Exception: registros, completo, n_req, itens = [], False, 0, 0
+
+                dt_start, dt_end, id_conta, id_pesquisa, _ = fatias[i]
+                requisicoes += n_req
+                telemetria.observar("paginas_por_fatia", n_req)
+                _contar(id_conta, id_pesquisa, dt_start, registros)
+                if completo:
+                    _densidades[(url, str(id_conta), str(id_pesquisa))] = itens / ((dt_end - dt_start).days + 1)
+                    try:
+                        gravar_checkpoint(conn, job, id_conta, id_pesquisa, dt_start, dt_end, registros)
+                        if usar_cache: gravar_cache(conn, id_conta, id_pesquisa, dt_start, dt_end, registros)
+                    except sqlite3.Error: pass
+                else:
+                    incompletas += 1
+                concluidas[i] = registros
+                _avancar(i)
+    finally:
+        for fut in em_andamento: fut.cancel()
+        incompletas += len(fila) + len(em_andamento)
+        if proprio_pool: pool.shutdown(wait=True)
+
+    # Download inteiro concluído: o checkpoint não é mais necessário
+    if not incompletas:
+        try: limpar_checkpoint(conn, job)
+        except sqlite3.Error: pass
+    conn.close()
+
+    estimativa_fixa = sum(requisicoes_janela_fixa(contagem_dias.get((c, p), {}), d_ini, d_fim, limit_size)
+                          for c in lista_contas for p in lista_pesquisas)
+    with telemetria.etapa("dataframe"): df = buffer.para_dataframe()
+    # Deduplicação de uma vez só, vetorizada; a mesclagem em ordem garante que a primeira ocorrência fica
+    with telemetria.etapa("dedup"):
+        recebidas = len(df)
+        df = deduplicar(df, indice)
+    telemetria.contar("linhas", recebidas - len(df), "duplicadas")
+    telemetria.registrar_etapa("download", time.perf_counter() - inicio_download)
+    df.attrs["telemetria"] = telemetria.para_dict()
+    df.attrs["estatisticas_download"] = {
+        "requisicoes": requisicoes,
+        "fatias_cache": total_cache,
+        "fatias_retomadas": total_checkpoint,
+        "fatias_incompletas": incompletas,
+        "requisicoes_janela_fixa": estimativa_fixa,
+        "requisicoes_economizadas": estimativa_fixa - requisicoes,     # negativo: custou mais que as janelas fixas
+    }
+    return df
+
+# ==============================================================================
+# DADOS COMPARTILHADOS
+# ==============================================================================
+
+def chave_conteudo(df, base_url=""):
+    """Identidade do conjunto: as chaves de dedup (ordenadas) + o domínio do servidor. Mesmas respostas, mesma chave."""
+    h = hashlib.sha1(dominio_atendimento(base_url).encode())
+    h.update(np.sort(df['Chave'].to_numpy(dtype=np.uint64)).tobytes())
+    return h.hexdigest()[:20]
+
+def chave_pedido(base_url, lista_contas, lista_pesquisas, d_ini, d_fim, arquivos=()):
+    """Identidade de um pedido de download (API + conteúdo dos arquivos), para achar o conjunto sem baixar."""
+    partes = [chave_job(base_url, lista_contas, lista_pesquisas or [], d_ini, d_fim)]
+    partes += sorted(hashlib.sha1(conteudo).hexdigest() for _, conteudo in arquivos)
+    return hashlib.sha1(repr(partes).encode()).hexdigest()[:20]
+
+class ConjuntoDados:
+    """Um relatório processado (DataFrame + cubo) guardado uma vez no processo. Tratado como somente leitura."""
+    def __init__(self, chave, df, cubo, indice=None, estatisticas=None, relatorio_upload=None, telemetria=None):
+        self.chave = chave
+        self.df = df
+        self.cubo = cubo
+        self._indice = indice
+        self.estatisticas = estatisticas
+        self.relatorio_upload = relatorio_upload
+        self.telemetria = telemetria        # Retrato das medições do download que gerou o conjunto
+        self.linhas = len(df)
+        self.bytes = int(df.memory_usage(deep=True).sum() + cubo.memory_usage(deep=True).sum())
+        self.usado_em = time.time()
+
+    @property
+    def indice(self):
+        if self._indice is None: self._indice = IndiceDedup(self.df['Chave'].to_numpy(), self.df['Chave_Base'].to_numpy())
+        return self._indice
+
+class RepositorioDados:
+    """
+    Conjuntos de dados do processo, por chave de conteúdo: sessões e jobs guardam só a chave, então a
+    RAM cresce com os relatórios distintos, não com os usuários. Passando de limite_mb, os menos usados
+    vão para arquivos Arrow em pasta (relidos por inteiro quando alguém os pede). Um índice
+    de pedidos (chave_pedido -> chave de conteúdo) permite entregar o mesmo relatório sem baixar de novo.
+    Conjuntos sem uso há VALIDADE_DADOS_H são esquecidos (com os arquivos) a cada registro ou leitura.
+    """
+    def __init__(self, limite_mb=LIMITE_MEMORIA_DADOS_MB, pasta=DADOS_DIR):
+        self.limite = limite_mb * 2**20
+        self.pasta = pasta
+        self.conjuntos = OrderedDict()     # chave -> ConjuntoDados (em memória ou despejado, df None); ordem = uso
+        self.pedidos = {}                  # chave_pedido -> (chave, valido_ate)
+        self.lock = threading.Lock()
+        self._expurgar_pasta()
+
+    def _caminho(self, chave, parte):
+        return os.path.join(self.pasta, f"{chave}.{parte}.arrow")
+
+    def _expurgar_pasta(self):
+        """Arquivos antigos deixados por processos anteriores (os deste processo saem em _expirar)."""
+        if not os.path.isdir(self.pasta): return
+        limite = time.time() - VALIDADE_DADOS_H * 3600
+        for nome in os.listdir(self.pasta):
+            caminho = os.path.join(self.pasta, nome)
+            try:
+                if nome.endswith(".arrow") and os.path.getmtime(caminho) < limite: os.remove(caminho)
+            except OSError: pass
+
+    def _remover(self, chave):
+        """Esquece o conjunto e apaga os arquivos dele, se tinha sido despejado."""
+        self.conjuntos.pop(chave, None)
+        for parte in ("dados", "cubo"):
+            try: os.remove(self._caminho(chave, parte))
+            except OSError: pass
+
+    def _expirar(self):
+        """Remove os conjuntos sem uso há VALIDADE_DADOS_H e os pedidos vencidos ou sem conjunto."""
+        agora = time.time()
+        limite = agora - VALIDADE_DADOS_H * 3600
+        for chave, conjunto in list(self.conjuntos.items()):
+            if conjunto.usado_em >= limite: break   # ordem de uso: os seguintes são mais recentes
+            self._remover(chave)
+        for pedido, (chave, valido_ate) in list(self.pedidos.items()):
+            if valido_ate < agora or chave not in self.conjuntos: del self.pedidos[pedido]
+
+    def memoria(self):
+        return sum(c.bytes for c in self.conjuntos.values() if c.df is not None)
+
+    def registrar(self, df, cubo, base_url="", indice=None, estatisticas=None, relatorio_upload=None, telemetria=None):
+        """Guarda o conjunto (ou devolve o que já existe com o mesmo conteúdo, descartando a cópia nova)."""
+        chave = chave_conteudo(df, base_url)
+        with self.lock:
+            existente = self.conjuntos.get(chave)
+            if existente is not None and existente.df is not None:
+                existente.usado_em = time.time()
+                self.conjuntos.move_to_end(chave)
+                self._expirar()
+                return existente
+            conjunto = self.conjuntos[chave] = ConjuntoDados(chave, df, cubo, indice, estatisticas, relatorio_upload,
+                                                             telemetria.copia() if telemetria else None)
+            self.conjuntos.move_to_end(chave)
+            self._despejar()
+            return conjunto
+
+    def obter(self, chave):
+        """Conjunto da chave (relendo do disco se tinha sido despejado) ou None se não existe mais."""
+        if not chave: return None
+        with self.lock:
+            conjunto = self.conjuntos.get(chave)
+            if conjunto is None: return None
+            if conjunto.df is None:
+                try:
+                    conjunto.df = feather.read_feather(self._caminho(chave, "dados"))
+                    conjunto.cubo = feather.read_feather(self._caminho(chave, "cubo"))
+                except (OSError, ValueError):
+                    self._remover(chave)
+                    return None
+            conjunto.usado_em = time.time()
+            self.conjuntos.move_to_end(chave)
+            self._despejar()
+            return conjunto
+
+    def _despejar(self):
+        """Expira o que venceu e tira da memória os menos usados (nunca o último pedido) até caber no limite. Sem pyarrow, nada sai."""
+        self._expirar()
+        if feather is None: return
+        memoria = self.memoria()
+        for chave, conjunto in list(self.conjuntos.items())[:-1]:
+            if memoria <= self.limite: break
+            if conjunto.df is None: continue
+            try:
+                os.makedirs(self.pasta, exist_ok=True)
+                if not os.path.exists(self._caminho(chave, "dados")):
+                    feather.write_feather(conjunto.df, self._caminho(chave, "dados"), compression="uncompressed")
+                    feather.write_feather(conjunto.cubo, self._caminho(chave, "cubo"), compression="uncompressed")
+            except (OSError, ValueError):
+                continue
+            memoria -= conjunto.bytes
+            conjunto.df = conjunto.cubo = conjunto._indice = None
+
+    def associar_pedido(self, pedido, chave, d_fim):
+        """Lembra que o pedido gerou o conjunto. Com dias ainda abertos, só por VALIDADE_PEDIDO_ABERTO_S."""
+        valido_ate = float("inf") if dia_fechado(d_fim) else time.time() + VALIDADE_PEDIDO_ABERTO_S
+        with self.lock: self.pedidos[pedido] = (chave, valido_ate)
+
+    def buscar_pedido(self, pedido):
+        with self.lock:
+            chave, valido_ate = self.pedidos.get(pedido, (None, 0))
+            if chave and (valido_ate < time.time() or chave not in self.conjuntos):
+                del self.pedidos[pedido]
+                return None
+        return self.obter(chave)
+
+# ==============================================================================
+# DOWNLOADS EM SEGUNDO PLANO
+# ==============================================================================
+
+class JobDownload:
+    """Um download em segundo plano (interface ou CLI); o resultado fica aqui até ser consumido."""
+    def __init__(self, descricao):
+        self.id = uuid.uuid4().hex[:8]
+        self.descricao = descricao
+        self.status = "Na fila"
+        self.progresso = 0.0
+        self.mensagem = "Aguardando na fila..."
+        self.repositorio = None
+        self.pedido = None
+        self.chave_dados = None         # Chave do resultado no repositório (o job não segura o DataFrame)
+        self.estatisticas = None
+        self.relatorio_upload = None
+        self.token = None
+        self.erro = None
+        self.criado_em = time.time()
+        self.finalizado_em = None
+        self.cancelar = threading.Event()
+        self.telemetria = Telemetria()
+        self.seguidores = []            # Jobs das sessões que aguardam este download (pedidos iguais baixam uma vez só)
+
+    @property
+    def ativo(self):
+        return self.status in ("Na fila", "Baixando")
+
+    @property
+    def dados(self):
+        return self.repositorio.obter(self.chave_dados) if self.repositorio else None
+
+    @property
+    def df(self):
+        conjunto = self.dados
+        return conjunto.df if conjunto else None
+
+    @property
+    def cubo(self):
+        conjunto = self.dados
+        return conjunto.cubo if conjunto else None
+
+    def atualizar(self, fracao, mensagem):
+        self.progresso = fracao
+        self.mensagem = mensagem
+        self.espelhar()
+
+    def interrompido(self):
+        """O download para quando este job for cancelado ou todos os seguidores dele forem."""
+        if self.seguidores and all(s.cancelar.is_set() for s in self.seguidores): self.cancelar.set()
+        return self.cancelar.is_set()
+
+    def espelhar(self):
+        """Copia andamento e resultado para os seguidores ainda em aberto; o que foi cancelado se desliga."""
+        for s in list(self.seguidores):
+            if s.finalizado_em: continue
+            if s.cancelar.is_set():
+                s.status, s.mensagem, s.finalizado_em = "Cancelado", "Download cancelado.", time.time()
+                continue
+            s.status, s.progresso, s.mensagem, s.erro = self.status, self.progresso, self.mensagem, self.erro
+            s.chave_dados, s.estatisticas, s.relatorio_upload, s.token = self.chave_dados, self.estatisticas, self.relatorio_upload, self.token
+            # Cada sessão mede as próprias etapas a partir de um retrato do download (não do mesmo objeto)
+            if self.finalizado_em: s.telemetria = self.telemetria.copia()
+            s.finalizado_em = self.finalizado_em
+
+def executar_download(job, base_url, lista_contas, lista_pesquisas, d_ini, d_fim, limit_size, max_workers,
+                      usar_cache, autenticador, arquivos, pool):
+    """Corpo do job: API + uploads + processamento."""
+    if job.interrompido():
+        job.status = "Cancelado"
+        job.mensagem = "Download cancelado."
+        job.finalizado_em = time.time()
+        job.espelhar()
+        return
+    job.status = "Baixando"
+    try:
+        frames = []
+        indice = IndiceDedup()
+        if lista_pesquisas:
+            df_api = baixar_dados_fracionado(base_url, autenticador.token, lista_contas, lista_pesquisas, d_ini, d_fim, limit_size,
+                                             max_workers=max_workers, usar_cache=usar_cache, autenticador=autenticador,
+                                             progresso=job.atualizar, pool=pool, cancelar=job.interrompido,
+                                             telemetria=job.telemetria, indice=indice)
+            job.token = autenticador.token
+            job.estatisticas = df_api.attrs.get("estatisticas_download")
+            frames.append(df_api)
+        if arquivos and not job.interrompido():
+            job.atualizar(job.progresso, f"📂 Lendo {len(arquivos)} arquivo(s)...")
+            with job.telemetria.etapa("leitura_arquivos"): frames_upload, job.relatorio_upload = ler_uploads(arquivos)
+            # Uploads passam pelo mesmo índice da API: linhas já baixadas (ou repetidas entre arquivos) não entram
+            lidos = [r for r in job.relatorio_upload if r["Status"] == "OK"]
+            for rel, frame in zip(lidos, frames_upload):
+                with job.telemetria.etapa("dedup"): frame = deduplicar(frame, indice)
+                rel["Duplicadas"] = rel["Linhas"] - len(frame)
+                job.telemetria.contar("linhas", rel["Duplicadas"], "duplicadas")
+                frames.append(frame)
+
+        if job.interrompido():
+            job.status = "Cancelado"
+            job.mensagem = "Download cancelado."
+            return
+        frames = [f for f in frames if not f.empty]
+        if frames:
+            job.atualizar(1.0, "⚙️ Processando...")
+            df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+            with job.telemetria.etapa("processamento"): relatorio = processar_dados(df)
+            job.telemetria.contar("linhas", len(df) - len(relatorio), "descartadas")
+            job.telemetria.contar("linhas", len(relatorio), "mantidas")
+            del df, frames
+            with job.telemetria.etapa("agregacao"): cubo = montar_cubo(relatorio)
+            completo = not (job.estatisticas or {}).get("fatias_incompletas")
+            # Fatias incompletas deixariam dias subcontados no rollup; ele espera o download completo
+            if completo and lista_pesquisas:
+                with job.telemetria.etapa("rollup"):
+                    try:
+                        conn = abrir_cache()
+                        try: gravar_rollup(conn, relatorio, lista_contas, lista_pesquisas, d_ini, d_fim)
+                        finally: conn.close()
+                    except sqlite3.Error: job.telemetria.contar("falhas_rollup")
+            # Outro usuário com o mesmo conteúdo já carregado: fica a cópia que existe
+            conjunto = job.repositorio.registrar(relatorio, cubo, base_url, indice, job.estatisticas, job.relatorio_upload,
+                                                 job.telemetria)
+            job.chave_dados = conjunto.chave
+            if completo and job.pedido: job.repositorio.associar_pedido(job.pedido, conjunto.chave, d_fim)
+            job.status = "Concluído"
+            job.atualizar(1.0, f"✅ {conjunto.linhas:,} respostas".replace(",", "."))
+        else:
+            job.status = "Sem dados"
+            job.atualizar(1.0, "Nenhum dado encontrado para o período/pesquisa.")
+    except Exception as e:
+        job.status = "Erro"
+        job.erro = str(e)
+        job.mensagem = f"❌ {e}"
+    finally:
+        job.finalizado_em = time.time()
+        job.espelhar()
+
+class GerenciadorDownloads:
+    """
+    Fila de downloads do processo: no máximo MAX_JOBS_SIMULTANEOS rodam juntos e todos dividem
+    o mesmo pool de fatias (e o limitador de taxa por host). Na interface, uma instância atende todas as sessões.
+    """
+    def __init__(self, max_jobs=MAX_JOBS_SIMULTANEOS, max_workers=MAX_WORKERS_POOL, repositorio=None):
+        self.executor_jobs = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job-download")
+        self.pool_fatias = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fatia")
+        self.repositorio = repositorio if repositorio is not None else RepositorioDados()
+        self.jobs = {}                      # id -> job de cada sessão/CLI
+        self.downloads = {}                 # chave_pedido -> job que baixa de fato (seguido pelos jobs das sessões)
+        self.lock = threading.Lock()
+
+    def enfileirar(self, descricao, **parametros):
+        """
+        Põe o download na fila. Se o mesmo pedido já gerou um conjunto (e usar_cache), o job nasce
+        concluído apontando para ele, sem esperar vaga na fila. Se um pedido igual está na fila ou
+        baixando, o job passa a acompanhar esse download em vez de baixar de novo (e de dividir o checkpoint).
+        Cancelar um job só o desliga; o download para quando todos os jobs que o acompanham cancelam.
+        """
+        job = JobDownload(descricao)
+        job.repositorio = self.repositorio
+        job.pedido = chave_pedido(parametros["base_url"], parametros["lista_contas"], parametros["lista_pesquisas"],
+                                  parametros["d_ini"], parametros["d_fim"], parametros.get("arquivos") or ())
+        conjunto = self.repositorio.buscar_pedido(job.pedido) if parametros.get("usar_cache", True) else None
+        with self.lock:
+            self._expurgar()
+            self.jobs[job.id] = job
+            download = novo = None
+            if conjunto is None:
+                download = self.downloads.get(job.pedido)
+                novo = download is None or download.finalizado_em or download.interrompido()
+                if novo:
+                    download = self.downloads[job.pedido] = JobDownload(descricao)
+                    download.repositorio, download.pedido = self.repositorio, job.pedido
+                else:
+                    download.telemetria.contar("pedidos_acompanhados")
+                download.seguidores.append(job)
+        if conjunto is not None:
+            job.chave_dados = conjunto.chave
+            job.estatisticas = conjunto.estatisticas
+            job.relatorio_upload = conjunto.relatorio_upload
+            if conjunto.telemetria: job.telemetria = conjunto.telemetria.copia()
+            job.telemetria.contar("conjuntos_reaproveitados")
+            job.status = "Concluído"
+            job.atualizar(1.0, f"♻️ {conjunto.linhas:,} respostas (já carregadas no servidor)".replace(",", "."))
+            job.finalizado_em = time.time()
+            return job
+        if novo: self.executor_jobs.submit(executar_download, download, pool=self.pool_fatias, **parametros)
+        download.espelhar()
+        return job
+
+    def job(self, id_job):
+        with self.lock: return self.jobs.get(id_job)
+
+    def remover(self, id_job):
+        with self.lock: job = self.jobs.pop(id_job, None)
+        if job: job.cancelar.set()
+
+    def _expurgar(self):
+        limite = time.time() - VALIDADE_JOB_H * 3600
+        for id_job in [j.id for j in self.jobs.values() if j.finalizado_em and j.finalizado_em < limite]:
+            del self.jobs[id_job]
+        for pedido in [p for p, d in self.downloads.items() if d.finalizado_em]:
+            del self.downloads[pedido]
+
+# ==============================================================================
+# EXPORTAÇÃO
+# ==============================================================================
+
+def tabela_exportacao(df, base_url=""):
+    """Colunas de COLUNAS_EXPORT do relatório, com o Link montado a partir de Cod_Atendimento."""
+    tabela = df[[c for c in COLUNAS_EXPORT if c in df.columns]]
+    if 'Cod_Atendimento' in df.columns: tabela = tabela.assign(Link=links_atendimento(df['Cod_Atendimento'], base_url))
+    return tabela[[c for c in COLUNAS_EXPORT if c in tabela.columns]]
+
+def blocos_exportacao(df, base_url="", tamanho=LINHAS_POR_BLOCO):
+    """tabela_exportacao bloco a bloco: os links existem só para um bloco por vez."""
+    for inicio in range(0, len(df), tamanho):
+        yield tabela_exportacao(df.iloc[inicio:inicio + tamanho], base_url)
+
+def iterar_linhas(df, tamanho=LINHAS_POR_BLOCO):
+    """Gera as linhas do DataFrame (valores Python, NaN -> None) bloco a bloco, sem converter tudo de uma vez."""
+    for inicio in range(0, len(df), tamanho):
+        bloco = df.iloc[inicio:inicio + tamanho]
+        colunas = []
+        for c in bloco.columns:
+            serie = bloco[c]
+            if pd.api.types.is_datetime64_any_dtype(serie): serie = serie.dt.strftime('%d/%m/%Y %H:%M:%S')
+            serie = serie.astype(object)
+            colunas.append(serie.where(serie.notna(), None).tolist())
+        yield from zip(*colunas)
+
+def gerar_excel(df_resumo, df_brutos, base_url=""):
+    """
+    Gera Excel BLINDADO. 
+    Tenta usar xlsxwriter (modo de memória constante) para gráficos. Se não tiver, usa openpyxl
+    em modo write_only, apenas com dados. Em ambos os casos os Dados Brutos são gravados em streaming.
+    """
+    # Acima do limite a planilha seria truncada em silêncio (write_row devolve -1); recusa antes de gravar
+    if max(len(df_resumo), len(df_brutos)) > LIMITE_LINHAS_EXCEL:
+        raise ValueError(f"{len(df_brutos)} linhas excedem o limite do Excel ({LIMITE_LINHAS_EXCEL} por planilha). "
+                         "Use CSV compactado (.csv.gz) ou Parquet.")
+    output = io.BytesIO()
+    colunas = list(tabela_exportacao(df_brutos.iloc[:0]).columns)
+
+    try:
+        import xlsxwriter
+    except ImportError:
+        xlsxwriter = None
+
+    if xlsxwriter:
+        # Modo COMPLETO (Com Gráficos). constant_memory grava cada linha e descarta da memória.
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Resumo')
+        worksheet.write_row(0, 0, list(df_resumo.columns))
+        for i, linha in enumerate(iterar_linhas(df_resumo), start=1):
+            worksheet.write_row(i, 0, linha)
+
+        chart = workbook.add_chart({'type': 'column'})
+        max_row = len(df_resumo) + 1
+        chart.add_series({
+            'name':       'Satisfação (CSAT %)',
+            'categories': ['Resumo', 1, 0, max_row - 1, 0],
+            'values':     ['Resumo', 1, 1, max_row - 1, 1],
+            'gap':        20,
+        })
+        chart.set_title({'name': 'Ranking de Satisfação'})
+        chart.set_y_axis({'name': 'CSAT (%)', 'max': 100})
+        worksheet.insert_chart('E2', chart)
+
+        ws_brutos = workbook.add_worksheet('Dados Brutos')
+        ws_brutos.write_row(0, 0, colunas)
+        linhas = (linha for bloco in blocos_exportacao(df_brutos, base_url) for linha in iterar_linhas(bloco))
+        for i, linha in enumerate(linhas, start=1):
+            ws_brutos.write_row(i, 0, linha)
+        workbook.close()
+    else:
+        # Modo DE SEGURANÇA (Sem Gráficos) - usa openpyxl (padrão)
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        ws = workbook.create_sheet('Resumo')
+        ws.append(list(df_resumo.columns))
+        for linha in iterar_linhas(df_resumo):
+            ws.append(linha)
+        ws = workbook.create_sheet('Dados Brutos')
+        ws.append(colunas)
+        for bloco in blocos_exportacao(df_brutos, base_url):
+            for linha in iterar_linhas(bloco):
+                ws.append(linha)
+        workbook.save(output)
+
+    return output.getvalue()
+
+def gerar_csv_gz(df_brutos, base_url=""):
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode='wb') as gz, io.TextIOWrapper(gz, encoding='utf-8-sig', newline='') as txt:
+        if not len(df_brutos): tabela_exportacao(df_brutos).to_csv(txt, index=False, sep=';')
+        for i, bloco in enumerate(blocos_exportacao(df_brutos, base_url)):
+            bloco.to_csv(txt, index=False, header=i == 0, sep=';', date_format='%d/%m/%Y %H:%M:%S')
+    return output.getvalue()
+
+def gerar_parquet(df_brutos, base_url=""):
+    output = io.BytesIO()
+    tabela_exportacao(df_brutos, base_url).to_parquet(output, index=False)
+    return output.getvalue()
+
+def gerar_exportacao(formato, df_resumo, df_brutos, base_url=""):
+    """Gera o arquivo no formato escolhido (chave de FORMATOS_EXPORT); os links apontam para o domínio de base_url."""
+    extensao = FORMATOS_EXPORT[formato][0]
+    if extensao == "xlsx": return gerar_excel(df_resumo, df_brutos, base_url)
+    if extensao == "csv.gz": return gerar_csv_gz(df_brutos, base_url)
+    return gerar_parquet(df_brutos, base_url)
+
+def chave_exportacao(*partes):
+    return hashlib.sha1(repr(partes).encode()).hexdigest()